@@ -0,0 +1,82 @@
+"""
+Benchmark getfileinfomap throughput of a local cluster with ReadIndex and lease reads
+
+usage: python benchmarks/read_throughput.py [--servers N] [--threads N] [--seconds S]
+"""
+import argparse
+import contextlib
+import os
+import sys
+import time
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from rpc import BinaryRPCServer, BinaryServerProxy  # noqa: E402
+from server import READ_MODES, SurfstoreServer  # noqa: E402
+from state import ELECTION_TIMEOUT  # noqa: E402
+
+
+def run(args, read_mode):
+    """:return: reads per second of args.threads clients against the leader"""
+    rpc_servers = [BinaryRPCServer(('127.0.0.1', 0)) for _ in range(args.servers)]
+    server_list = [rpc_server.server_address for rpc_server in rpc_servers]
+    surfstores = []
+    for i, rpc_server in enumerate(rpc_servers):
+        surfstores.append(SurfstoreServer(SurfstoreServer.set_up_connections(server_list, i, 'binary'), i,
+                                          args.servers, read_mode=read_mode))
+        rpc_server.register_instance(surfstores[-1])
+        Thread(target=rpc_server.serve_forever, daemon=True).start()
+    try:
+        for surfstore in surfstores:
+            surfstore.restore()
+        while not any(surfstore.isLeader() for surfstore in surfstores):
+            time.sleep(ELECTION_TIMEOUT[0])
+        leader = next(i for i, surfstore in enumerate(surfstores) if surfstore.isLeader())
+        host, port = server_list[leader]
+        with BinaryServerProxy(host, port) as proxy:
+            for i in range(args.files):
+                proxy.updatefile(f'lala{i}.bin', 1, [os.urandom(32)])
+
+        counts = [0] * args.threads
+        deadline = time.monotonic() + args.seconds
+
+        def reader(index):
+            with BinaryServerProxy(host, port) as proxy:
+                while time.monotonic() < deadline:
+                    proxy.getfileinfomap()
+                    counts[index] += 1
+
+        threads = [Thread(target=reader, args=(i,)) for i in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return sum(counts) / args.seconds
+    finally:
+        for surfstore in surfstores:
+            surfstore.crash()
+        for rpc_server in rpc_servers:
+            rpc_server.shutdown()
+            rpc_server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="getfileinfomap throughput benchmark")
+    parser.add_argument('--servers', type=int, default=3, help='number of servers')
+    parser.add_argument('--threads', type=int, default=8, help='number of concurrent readers')
+    parser.add_argument('--files', type=int, default=10,
+                        help='number of files in the map, reads of large maps are bound by serialization')
+    parser.add_argument('--seconds', type=float, default=5, help='duration of each run')
+    args = parser.parse_args()
+
+    print(f"{args.servers} servers, {args.threads} readers, {args.files} files")
+    print("read mode   reads/s")
+    for read_mode in READ_MODES:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):  # servers log every RPC
+            reads = run(args, read_mode)
+        print(f"{read_mode:9s} {reads:9.0f}")
+
+
+if __name__ == '__main__':
+    main()
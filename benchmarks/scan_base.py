@@ -0,0 +1,60 @@
+"""
+Benchmark SurfstoreClient.scan_base with different numbers of hashing threads
+
+usage: python benchmarks/scan_base.py [--files N] [--file-size BYTES] [--block-size BYTES] [--chunking cdc]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from chunker import CDCChunker  # noqa: E402
+from client import SurfstoreClient  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="scan_base benchmark")
+    parser.add_argument('--files', type=int, default=8, help='number of files')
+    parser.add_argument('--file-size', type=int, default=64 << 20, help='size of each file')
+    parser.add_argument('--block-size', type=int, default=4096, help='block size, the average size with cdc')
+    parser.add_argument('--chunking', choices=('fixed', 'cdc'), default='fixed',
+                        help='cdc finds cut points in pure Python, use a smaller --file-size')
+    parser.add_argument('--repeat', type=int, default=3, help='best of this many runs is reported')
+    args = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp()
+    try:
+        for i in range(args.files):
+            with open(os.path.join(base_dir, f'lala{i}.bin'), 'wb') as f:
+                for _ in range(0, args.file_size, 1 << 20):
+                    f.write(os.urandom(min(1 << 20, args.file_size)))
+        total = args.files * args.file_size
+        cpus = os.cpu_count() or 1
+        print(f"{args.files} files of {args.file_size} bytes, {args.chunking} blocks of size {args.block_size}, "
+              f"{cpus} CPUs")
+        # same defaults as the client
+        chunker = CDCChunker(max(args.block_size // 4, 1), args.block_size, args.block_size * 4) \
+            if args.chunking == 'cdc' else None
+        print("threads  seconds   MB/s  speedup")
+        base = None
+        workers = 1
+        while workers <= 2 * cpus:
+            with SurfstoreClient(None, base_dir, args.block_size, hash_workers=workers, chunker=chunker) as client:
+                seconds = float('inf')
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    client.scan_base()  # files stay in page cache after the first run
+                    seconds = min(seconds, time.perf_counter() - start)
+            base = base or seconds
+            print(f"{workers:7d} {seconds:8.3f} {total / seconds / 1e6:6.0f} {base / seconds:8.2f}")
+            workers *= 2
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
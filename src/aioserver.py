@@ -0,0 +1,93 @@
+import asyncio
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+import codec
+from rpc import FRAME_HEADER, MAX_FRAME_SIZE
+
+MAX_WORKERS = 64  # max RPCs executed at the same time, other requests wait on the event loop
+PEER_WORKERS = 16  # max RPCs between servers executed at the same time, in a pool separate from clients
+# RPCs between servers, client calls may wait for them (e.g. updatefile for appendEntries replies) so they must
+# not queue behind client calls
+PEER_METHODS = ('appendEntries', 'requestVote', 'installSnapshot', 'readIndex', 'pushBlocks', 'pullBlocks')
+
+
+class AsyncRPCServer:
+    """
+    Binary RPC server on an asyncio event loop, speaks the same protocol as rpc.BinaryRPCServer
+    Connections are served by coroutines instead of one thread each, so idle or slow clients cost no thread
+    Methods of the registered instance may block (e.g. updatefile waits for commit), they run in a bounded pool
+    """
+
+    def __init__(self, addr, max_workers=MAX_WORKERS, peer_workers=PEER_WORKERS, peer_methods=PEER_METHODS):
+        self.addr = addr
+        self.instance = None
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='rpc')
+        self.peer_executor = ThreadPoolExecutor(peer_workers, thread_name_prefix='rpc-peer')
+        self.peer_methods = set(peer_methods)
+        self.server = None  # asyncio.Server
+        self.loop = None
+        self.ready = Event()  # set when listening, server_address is known after that
+        self.server_address = None
+
+    def register_instance(self, instance):
+        """instance should implement _dispatch(method, params)"""
+        self.instance = instance
+
+    async def handle(self, reader, writer):
+        """Serve requests on one connection in order until the client closes it"""
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(FRAME_HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break  # closed by client
+                length = FRAME_HEADER.unpack(header)[0]
+                if length > MAX_FRAME_SIZE:
+                    break
+                method, params = codec.loads(await reader.readexactly(length))
+                # methods may be called as surfstore.*
+                executor = self.peer_executor if method.split('.')[-1] in self.peer_methods else self.executor
+                try:
+                    response = [True, await self.loop.run_in_executor(executor, self.instance._dispatch,
+                                                                      method, params)]
+                except Exception as e:
+                    response = [False, f'{type(e)}:{e}']
+                payload = codec.dumps(response)
+                writer.write(FRAME_HEADER.pack(len(payload)) + payload)
+                await writer.drain()
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle, *self.addr)
+        self.server_address = self.server.sockets[0].getsockname()[:2]
+        self.ready.set()
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.executor.shutdown(wait=False)
+            self.peer_executor.shutdown(wait=False)
+
+    def shutdown(self):
+        """Stop serve_forever() from another thread"""
+        self.loop.call_soon_threadsafe(self.server.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.executor.shutdown(wait=False)
+        self.peer_executor.shutdown(wait=False)
@@ -0,0 +1,183 @@
+import mmap
+import os
+import struct
+from collections import OrderedDict
+from threading import Lock
+
+RECORD_HEADER = struct.Struct('>32sI')  # sha256 of block, block length
+SEGMENT_SIZE = 64 << 20  # start a new pack file when the current one exceeds this size
+SEGMENT_SUFFIX = '.pack'
+CACHE_SIZE = 64 << 20  # bytes of hot blocks kept in memory
+
+
+class DiskBlockStore:
+    """
+    Content-addressed block store on disk, a drop-in replacement of SurfStore.blocks {hash: block}
+    Blocks are appended to packed segment files under directory as [hash, length, block] records
+    The in-memory index {hash: (segment, offset, length)} is rebuilt by scanning segments on start
+    Full segments are read through mmap, recently read blocks are kept in an LRU cache of cache_size bytes
+    Blocks are flushed to the OS on put, they survive a process crash, and a power loss once sync() returns
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, cache_size=CACHE_SIZE, use_mmap=True):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.cache_size = cache_size
+        self.use_mmap = use_mmap
+        self.lock = Lock()  # protects index, cache, files and the active segment
+        self.sync_lock = Lock()  # serializes fsync, protects synced
+        self.written = 0  # number of blocks written
+        self.synced = 0  # number of blocks durable on disk
+        self.index = {}  # {hash: (segment, offset of block, length)}
+        self.cache = OrderedDict()  # {hash: block} in LRU order, least recent first
+        self.cached_bytes = 0
+        self.files = {}  # {segment: file opened for reading}
+        self.maps = {}  # {segment: mmap}, only full segments are mapped
+        self.active = None  # segment being appended
+        self.file = None  # active segment opened for appending
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def path(self, segment):
+        return os.path.join(self.directory, f'{segment:08d}{SEGMENT_SUFFIX}')
+
+    def load(self):
+        """
+        Rebuild index from all segments and open the last one for appending
+        A torn record at the tail of the last segment is truncated
+        """
+        segments = self.segments()
+        for segment in segments:
+            size = os.path.getsize(self.path(segment))
+            with open(self.path(segment), 'rb') as f:
+                offset = 0
+                while offset < size:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) == RECORD_HEADER.size:
+                        h, length = RECORD_HEADER.unpack(header)
+                        start = offset + RECORD_HEADER.size
+                        if start + length <= size:
+                            self.index[h] = segment, start, length
+                            offset = start + length
+                            f.seek(offset)
+                            continue
+                    if segment != segments[-1]:
+                        raise Exception(f"corrupted record in {self.path(segment)} at {offset}")
+                    print(f"DiskBlockStore: truncate torn record in {self.path(segment)} at {offset}")
+                    with open(self.path(segment), 'r+b') as wf:
+                        wf.truncate(offset)
+                    break
+        self.open_segment(segments[-1] if segments else 0)
+        print(f"DiskBlockStore: {len(self.index)} blocks in {len(segments)} segments")
+
+    def open_segment(self, segment):
+        """
+        Make segment the active one
+        Assume calling thread acquired self.lock or no other thread uses the store yet
+        """
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            if self.use_mmap and os.path.getsize(self.path(self.active)):
+                self.maps[self.active] = mmap.mmap(self.reader(self.active).fileno(), 0, access=mmap.ACCESS_READ)
+        self.active = segment
+        self.file = open(self.path(segment), 'ab')
+
+    def reader(self, segment):
+        """Assume calling thread acquired self.lock"""
+        if segment not in self.files:
+            self.files[segment] = open(self.path(segment), 'rb')
+        return self.files[segment]
+
+    def read(self, segment, offset, length):
+        """Assume calling thread acquired self.lock"""
+        if segment in self.maps:
+            return self.maps[segment][offset:offset + length]
+        f = self.reader(segment)
+        f.seek(offset)
+        return f.read(length)
+
+    def __getitem__(self, h):
+        with self.lock:
+            block = self.cache.get(h)
+            if block is not None:
+                self.cache.move_to_end(h)
+                return block
+            segment, offset, length = self.index[h]  # KeyError as dict
+            block = self.read(segment, offset, length)
+            if length <= self.cache_size:
+                self.cache[h] = block
+                self.cached_bytes += length
+                while self.cached_bytes > self.cache_size:
+                    _, evicted = self.cache.popitem(last=False)
+                    self.cached_bytes -= len(evicted)
+            return block
+
+    def __setitem__(self, h, block):
+        with self.lock:
+            if h in self.index:
+                return  # content-addressed, the same hash has the same block
+            if self.file.tell() >= self.segment_size:
+                self.open_segment(self.active + 1)
+            offset = self.file.tell()
+            self.file.write(RECORD_HEADER.pack(h, len(block)) + block)
+            self.file.flush()  # visible to readers of the segment
+            self.index[h] = self.active, offset + RECORD_HEADER.size, len(block)
+            self.written += 1
+
+    def __contains__(self, h):
+        return h in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def get(self, h, default=None):
+        try:
+            return self[h]
+        except KeyError:
+            return default
+
+    def sync(self):
+        """
+        Make put blocks durable, full segments are fsynced when the next one starts
+        Callers arriving during an fsync wait for it and are covered by the next one (group commit)
+        """
+        with self.sync_lock:
+            with self.lock:
+                if self.synced >= self.written:
+                    return
+                target = self.written
+                # fsync a duplicate so puts can continue, and roll over, while we wait on the disk
+                fd = os.dup(self.file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.synced = target
+
+    def close(self):
+        with self.lock:
+            for m in self.maps.values():
+                m.close()
+            for f in self.files.values():
+                f.close()
+            self.maps, self.files = {}, {}
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,90 @@
+from hashlib import sha256
+
+READ_SIZE = 1 << 20  # bytes read from file at a time by CDCChunker
+MASK64 = (1 << 64) - 1
+# random but fixed gear table, all clients must cut at the same points to share blocks
+GEAR = [int.from_bytes(sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
+
+
+class FixedChunker:
+    """
+    Split files at fixed block_size offsets
+    """
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+
+    def params(self):
+        """Chunks are the same as long as params are the same"""
+        return ['fixed', self.block_size]
+
+    def chunks(self, f):
+        """Yield blocks of binary file f"""
+        while True:
+            block = f.read(self.block_size)
+            if not block:
+                return
+            yield block
+
+
+class CDCChunker:
+    """
+    Content-defined chunking with a Gear rolling hash and normalized chunking as in FastCDC
+    Cut points depend only on nearby content, so an insertion changes the blocks around it only
+    That is the block containing it and the blocks after it until both versions cut at the same point again,
+    usually at the next cut point, but cut points within min_size of a shifted block start are skipped, and cuts
+    forced at max_size in content without cut points shift as well, so a few more blocks may change
+    Block sizes are in [min_size, max_size] except the last one, around avg_size on average
+    Cut points are found byte by byte in Python holding the GIL, so a file is scanned at only about 5-10 MB/s
+    and hashing threads do not help, see benchmarks/scan_base.py --chunking cdc
+    """
+
+    def __init__(self, min_size, avg_size, max_size):
+        assert 0 < min_size <= avg_size <= max_size, "Chunk sizes must be min <= avg <= max"
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        bits = max(avg_size.bit_length() - 1, 2)  # log2(avg_size)
+        # harder to cut before avg_size and easier after it, sizes gather around avg_size
+        self.mask_small = ((1 << (bits + 1)) - 1) << (64 - bits - 1)
+        self.mask_large = ((1 << (bits - 1)) - 1) << (64 - bits + 1)
+
+    def params(self):
+        """Chunks are the same as long as params are the same"""
+        return ['cdc', self.min_size, self.avg_size, self.max_size]
+
+    def cut(self, data, start, end):
+        """
+        Find the end of the block starting at start in data[start:end], end - start is at most max_size
+        """
+        if end - start <= self.min_size:
+            return end
+        normal = min(start + self.avg_size, end)
+        fp = 0
+        gear, mask = GEAR, self.mask_small
+        for i in range(start + self.min_size, normal):
+            fp = ((fp << 1) + gear[data[i]]) & MASK64
+            if not fp & mask:
+                return i + 1
+        mask = self.mask_large
+        for i in range(normal, end):
+            fp = ((fp << 1) + gear[data[i]]) & MASK64
+            if not fp & mask:
+                return i + 1
+        return end
+
+    def chunks(self, f):
+        """Yield blocks of binary file f"""
+        buf, pos, eof = b'', 0, False
+        while True:
+            if not eof and len(buf) - pos < self.max_size:
+                data = f.read(max(READ_SIZE, self.max_size))
+                eof = not data
+                buf = buf[pos:] + data
+                pos = 0
+                continue
+            if pos == len(buf):
+                return
+            end = self.cut(buf, pos, min(pos + self.max_size, len(buf)))
+            yield buf[pos:end]
+            pos = end
@@ -1,28 +1,373 @@
 import argparse
+import http.client
 import os
+import random
+import re
+import socket
+import time
 import xmlrpc.client
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from hashlib import sha256
+from threading import Lock, local
+
+import codec
+from chunker import CDCChunker, FixedChunker
+from compression import available, compress, decompress
+from rpc import BinaryServerProxy
+from server import TimeoutTransport, readconfig, ring_of
+
+MAX_BATCH_BYTES = 4 << 20  # max total size of blocks sent by one putblocks() or asked by one getblocks()
+WORKERS = 4  # number of concurrent block transfers
+HASH_WORKERS = os.cpu_count() or 1  # number of threads hashing blocks, sha256 releases the GIL on blocks over 2KB
+HASH_RANGE_SIZE = 16 << 20  # bytes of a file hashed by one task, large files are hashed by several threads
+TEMP_SUFFIX = '.surfstore-tmp'  # suffix of files being downloaded, ignored by scan_base
+# files modified this recently are not put into the hash cache, a later write may not change mtime
+RACY_WINDOW = 2
+RETRY_TIMEOUT = 10  # seconds a call to a cluster is retried before giving up, elections take a few seconds at most
+RETRY_DELAY = 0.1  # seconds to wait before trying the next server if no leader is hinted, e.g. during elections
+NOT_LEADER = re.compile(r'is not Leader(?:, leader is (\d+))?')  # error of a server that is not leader
+
+
+class ClusterProxy:
+    """
+    Server proxy of a Raft cluster, used like xmlrpc.client.ServerProxy, calls go to the leader
+    The leader is cached, servers that are not leader redirect calls to the leader they hint,
+    or the next server is tried, servers that can not be reached are skipped
+    Thread-safe if proxies are, proxies keep persistent connections so failover does not reconnect
+    """
+
+    def __init__(self, proxies, leader=0, retry_timeout=RETRY_TIMEOUT):
+        """
+        :param proxies: server proxies indexed by server id as in the config file
+        :param leader: id of the server tried first
+        """
+        self.proxies = proxies
+        self.leader = leader
+        self.retry_timeout = retry_timeout
+        self.lock = Lock()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*params):
+            return self.call(name, params)
+
+        return call
+
+    def updatefile(self, filename, version, blocklist):
+        """
+        updatefile is not idempotent, if a call committed but its reply is lost, the retry fails on the version
+        The update is successful then if the file info map has exactly this version
+        """
+        result, maybe_sent = self.call_leader('updatefile', (filename, version, blocklist))
+        if result or not maybe_sent:
+            return result
+        info = self.call('getfileinfomap', ()).get(filename)
+        return info is not None and info[0] == version and list(info[1]) == list(blocklist)
+
+    def call(self, method, params):
+        """
+        Call method on the leader, errors of the method and errors after retry_timeout are raised
+        """
+        return self.call_leader(method, params)[0]
+
+    def call_leader(self, method, params):
+        """
+        Call method on the leader, errors of the method and errors after retry_timeout are raised
+        :return: result, whether a failed call may have been executed, i.e. failed after the request was sent
+        """
+        deadline = time.monotonic() + self.retry_timeout
+        maybe_sent = False
+        while True:
+            server_id = self.leader
+            try:
+                return getattr(self.proxies[server_id], method)(*params), maybe_sent
+            except (OSError, http.client.HTTPException, xmlrpc.client.ProtocolError) as e:
+                if time.monotonic() > deadline:
+                    raise
+                print(f"server {server_id} is unreachable: {e}")
+                maybe_sent = maybe_sent or not isinstance(e, ConnectionRefusedError)
+                hint = None
+            except Exception as e:  # raised by the remote method, xmlrpc.client.Fault or RPCError
+                match = NOT_LEADER.search(str(e))
+                if match is None or time.monotonic() > deadline:
+                    raise
+                hint = match.group(1) and int(match.group(1))
+            if hint is None or hint == server_id or not 0 <= hint < len(self.proxies):
+                time.sleep(RETRY_DELAY)
+                hint = (server_id + 1) % len(self.proxies)
+            with self.lock:
+                if self.leader == server_id:  # another thread may have found the leader
+                    self.leader = hint
+
+    def close(self):
+        for proxy in self.proxies:
+            proxy.__exit__(None, None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 class SurfstoreClient:
-    def __init__(self, server, base_dir, block_size):
+    def __init__(self, server, base_dir, block_size, workers=WORKERS, connect=None, hash_cache=None,
+                 hash_workers=HASH_WORKERS, chunker=None, compression=None, map_cache=None, readers=None,
+                 ring=None, block_servers=None):
+        """
+        :param block_size: size of blocks, or the average size if chunker is content-defined
+        :param workers: number of threads transferring blocks concurrently
+        :param connect: function creating a new server proxy, called once by each worker
+                        if server proxy is not thread-safe, by default workers share server
+        :param hash_cache: path of the file caching hashes of unchanged files between runs, no cache by default
+        :param hash_workers: number of threads hashing files when scanning
+        :param chunker: how files are split into blocks, FixedChunker(block_size) by default
+        :param compression: one of compression.available() to compress blocks on the wire if the server supports it,
+                            negotiated by run(), blocks are sent raw by default
+        :param map_cache: path of the file keeping server's fileinfomap between runs, so that only changes are
+                          transferred, the map is kept only in memory by default
+        :param readers: functions each creating a server proxy to one server of the cluster, fileinfomap and
+                        blocks are read from them in turn by each thread, falling back to server if a read fails,
+                        all reads go to server by default
+        :param ring: HashRing placing blocks on servers as configured on servers, blocks are put to, got from
+                     and checked on their primary owners in block_servers, server proxies by server id,
+                     or on their next owners if the call fails, all block calls go to server by default
+        """
         self.server = server
         self.base_dir = base_dir
         self.block_size = block_size
-        self.file_blocks = {}  # {file_name: blocks}
+        self.chunker = FixedChunker(block_size) if chunker is None else chunker
+        self.preferred_compression = compression
+        self.compression = None  # compression agreed with server
+        self.hash_cache = hash_cache
+        self.map_cache = map_cache
+        self.remote_infos = None  # server's fileinfomap as of cursor, None if not read yet
+        self.cursor = 0  # returned by server's getfileinfomap_since()
+        self.file_blocks = {}  # {file_name: [(offset, length) of blocks]}, blocks are read again when uploading
+        # {hash: (file_name, offset, length)} of blocks in base dir, downloads copy them instead of fetching
+        # may be outdated after files are replaced, blocks are checked against hash when copied
+        self.local_blocks = {}
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='transfer')
+        self.hash_pool = ThreadPoolExecutor(hash_workers, thread_name_prefix='hash')
+        self.connect = connect
+        self.local = local()  # server proxy of each worker
+        self.worker_servers = ExitStack()  # proxies created by connect, closed by close()
+        self.worker_servers_lock = Lock()
+        self.readers = readers or []
+        self.next_reader = random.randrange(len(self.readers)) if self.readers else 0  # spread clients as well
+        self.ring = ring
+        self.block_servers = block_servers
 
         os.makedirs(self.base_dir, exist_ok=True)
 
     def download(self, file_name):
         """
-        Get server's fileinfomap first, then download all its blocks to self.files
+        Get server's fileinfomap first if not cached, then download all its blocks to self.files
+        Blocks found in local_blocks are copied from local files, only the others are fetched from server
+        The file is written to a temporary file first, then atomically replaces the old one
         :param file_name: name of the file download from server
         """
-        remote_infos = self.get_fileinfomap()
-        if remote_infos[file_name][1]:  # don't download deleted file
-            with open(os.path.join(self.base_dir, file_name), 'wb') as f:
-                for h in remote_infos[file_name][1]:
-                    f.write(self.server.getblock(h))
+        if self.remote_infos is None or file_name not in self.remote_infos:
+            self.get_fileinfomap()
+        hashes = self.remote_infos[file_name][1]
+        if not hashes:  # don't download deleted file
+            return
+        batch_len = max(1, MAX_BATCH_BYTES // self.block_size)
+        items = []  # blocks in file order, hash of a local block or list of hashes fetched in one batch
+        for h in hashes:
+            if h in self.local_blocks:
+                items.append(h)
+            elif items and isinstance(items[-1], list) and len(items[-1]) < batch_len:
+                items[-1].append(h)
+            else:
+                items.append([h])
+        batches = deque(item for item in items if isinstance(item, list))
+        pending = deque()  # futures of batches in file order
+        sources = {}  # {file_name: opened local file}
+        path = os.path.join(self.base_dir, file_name)
+        blocks = []  # [(offset, length) of blocks] of the new file
+        # an incomplete file is left if interrupted, ignored by scan_base and overwritten by the next download
+        with open(path + TEMP_SUFFIX, 'wb') as f:
+            try:
+                for item in items:
+                    # keep fetching ahead, bound the number of downloaded batches held in memory
+                    while batches and len(pending) < 2 * self.workers:
+                        pending.append(self.pool.submit(self.get_blocks, batches.popleft()))
+                    if isinstance(item, list):
+                        new_blocks = pending.popleft().result()
+                    else:
+                        new_blocks = [self.copy_block(item, sources)]
+                    for block in new_blocks:
+                        blocks.append((f.tell(), len(block)))
+                        f.write(block)
+            finally:
+                for future in pending:
+                    future.cancel()
+                for source in sources.values():
+                    source.close()
+        os.replace(path + TEMP_SUFFIX, path)
+        self.file_blocks[file_name] = blocks
+        for h, (offset, length) in zip(hashes, blocks):
+            self.local_blocks[h] = file_name, offset, length
+
+    def copy_block(self, h, sources):
+        """
+        Read the block of hash h from local files, fetch it from server if the local file has changed
+        :param sources: {file_name: opened local file}, files opened are added to it
+        """
+        file_name, offset, length = self.local_blocks[h]
+        try:
+            if file_name not in sources:
+                sources[file_name] = open(os.path.join(self.base_dir, file_name), 'rb')
+            sources[file_name].seek(offset)
+            block = sources[file_name].read(length)
+            if sha256(block).digest() == h:
+                return block
+        except OSError:
+            pass  # deleted
+        del self.local_blocks[h]
+        return self.get_blocks([h])[0]
+
+    def worker_server(self):
+        """
+        Server proxy of the calling worker thread
+        """
+        if self.connect is None:
+            return self.server
+        server = getattr(self.local, 'server', None)
+        if server is None:
+            server = self.local.server = self.connect()
+            with self.worker_servers_lock:
+                self.worker_servers.enter_context(server)
+        return server
+
+    def reader(self):
+        """
+        Server proxy of the calling thread to read from, None if there are no readers
+        """
+        if not self.readers:
+            return None
+        reader = getattr(self.local, 'reader', None)
+        if reader is None:
+            with self.worker_servers_lock:
+                connect = self.readers[self.next_reader % len(self.readers)]
+                self.next_reader += 1
+                reader = self.local.reader = self.worker_servers.enter_context(connect())
+        return reader
+
+    def read(self, func, server, *args):
+        """
+        Call func(reader, *args) with the reader of the calling thread, func(server, *args) if it fails
+        A follower may refuse reads, or miss blocks put on the leader
+        """
+        reader = self.reader()
+        if reader is not None:
+            try:
+                return func(reader, *args)
+            except Exception as e:
+                print(f"read from replica failed, read from server: {e}")
+        return func(server, *args)
+
+    def get_blocks(self, hashes):
+        """
+        Get all blocks of hashes in order, run by workers
+        With a ring, get them from their owners, any server pulls blocks it is missing otherwise
+        """
+        if self.ring is None:
+            return self.read(self.fetch_blocks, self.worker_server(), hashes)
+        blocks = [None] * len(hashes)
+
+        def fetch(server, indexes):
+            for i, block in zip(indexes, self.fetch_blocks(server, [hashes[i] for i in indexes])):
+                blocks[i] = block
+
+        try:
+            self.call_owners(hashes, fetch)
+        except Exception as e:
+            print(f"get blocks from owners failed, get them from server: {e}")
+            fetch(self.worker_server(), [i for i, block in enumerate(blocks) if block is None])
+        return blocks
+
+    def call_owners(self, hashes, func):
+        """
+        Call func(server proxy, indexes of hashes) once for the hashes of each primary owner in block_servers
+        If a call fails, its hashes are grouped by their next owners and tried again, until no owners are left
+        :return: results of successful calls
+        """
+        results = []
+        groups, rank = self.ring.group(hashes), 0
+        while groups:
+            retries = {}
+            for server_id, indexes in groups.items():
+                try:
+                    results.append(func(self.block_servers[server_id], indexes))
+                except Exception as e:
+                    if rank + 1 >= self.ring.replicas:
+                        raise
+                    print(f"call to block server {server_id} failed, try the next owners: {e}")
+                    for i in indexes:
+                        retries.setdefault(self.ring.owners(hashes[i])[rank + 1], []).append(i)
+            groups, rank = retries, rank + 1
+        return results
+
+    def fetch_blocks(self, server, hashes):
+        """
+        Get all blocks of hashes in order from server
+        """
+        blocks = []
+        while len(blocks) < len(hashes):
+            # server returns as many blocks as fit in one batch
+            if self.compression is None:
+                new_blocks = server.getblocks(hashes[len(blocks):])
+            else:
+                new_blocks = [decompress(b) for b in server.getblocks(hashes[len(blocks):], self.compression)]
+            if not new_blocks:
+                raise Exception("server returned no blocks")
+            blocks.extend(new_blocks)
+        return blocks
+
+    def put_blocks(self, blocks):
+        """
+        Put blocks, run by workers
+        With a ring, put them to their primary owners, or next owners if it fails, which push them to the others
+        """
+        if self.ring is None:
+            return self.send_blocks(self.worker_server(), blocks)
+        self.call_owners([sha256(b).digest() for b in blocks],
+                         lambda server, indexes: self.send_blocks(server, [blocks[i] for i in indexes]))
+        return True
+
+    def send_blocks(self, server, blocks):
+        if self.compression is None:
+            return server.putblocks(blocks)
+        return server.putblocks([compress(b, self.compression) for b in blocks], True)
+
+    def has_blocks(self, hashes):
+        """
+        Hashes of blocks already on the server, asked to primary owners, or next owners if it fails, with a ring
+        """
+        if self.ring is None:
+            return self.server.hasblocks(hashes)
+        results = self.call_owners(hashes, lambda server, indexes: server.hasblocks([hashes[i] for i in indexes]))
+        return [h for stored in results for h in stored]
+
+    def negotiate_compression(self):
+        """
+        Use preferred compression if the server supports it, servers without compression support don't
+        """
+        self.compression = None
+        if self.preferred_compression is None:
+            return
+        try:
+            if self.preferred_compression in self.server.getcompressions():
+                self.compression = self.preferred_compression
+        except Exception as e:
+            print(f"server does not support compression: {e}")
 
     def delete(self, file_name, version):
         """
@@ -39,11 +384,36 @@ class SurfstoreClient:
         :return: True if succeed otherwise False
         """
         # hash of blocks already on the server
-        hash_server = set(self.server.hasblocks(file_info[1]))
-        for i in range(len(file_info[1])):
-            if not file_info[1][i] in hash_server:
-                # use index to get corresponding block
-                self.server.putblock(self.file_blocks[file_name][i])
+        hash_server = set(self.has_blocks(file_info[1]))
+        batch, size = [], 0
+        pending = deque()  # futures of batches being put
+        try:
+            with open(os.path.join(self.base_dir, file_name), 'rb') as f:
+                for i in range(len(file_info[1])):
+                    if not file_info[1][i] in hash_server:
+                        hash_server.add(file_info[1][i])  # put repeated blocks once
+                        # use index to get corresponding block
+                        offset, length = self.file_blocks[file_name][i]
+                        f.seek(offset)
+                        block = f.read(length)
+                        if sha256(block).digest() != file_info[1][i]:
+                            raise Exception(f"{file_name} is modified during sync")
+                        if batch and size + len(block) > MAX_BATCH_BYTES:
+                            pending.append(self.pool.submit(self.put_blocks, batch))
+                            batch, size = [], 0
+                            # bound the number of read batches held in memory
+                            if len(pending) >= 2 * self.workers:
+                                pending.popleft().result()
+                        batch.append(block)
+                        size += len(block)
+            if batch:
+                pending.append(self.pool.submit(self.put_blocks, batch))
+            # all blocks must be on the server before the file refers to them
+            while pending:
+                pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
         return self.server.updatefile(file_name, file_info[0], file_info[1])
 
     def read_index(self):
@@ -67,36 +437,168 @@ class SurfstoreClient:
     def scan_base(self):
         """
         Scan base dir, calculate hashlist for each file, use placeholder 1 for version
-        Populate files with file block
+        Populate file_blocks with offsets of blocks, only one block of a file is in memory at a time
         :return: dict {file_name: [version, [blocks' hash]]}
         """
         base_infos = {}
+        cache = self.read_hash_cache()
+        new_cache = {}
+        racy_since = time.time() - RACY_WINDOW
+        stats = {}  # {file_name: stat}
+        hashing = {}  # {file_name: futures of hashed ranges}
         for name in os.listdir(self.base_dir):
-            if name == 'index.txt':  # skip index
+            if name == 'index.txt' or name.endswith(TEMP_SUFFIX):  # skip index and incomplete downloads
                 continue
             path = os.path.join(self.base_dir, name)
+            if any(cache is not None and os.path.abspath(path) in (os.path.abspath(cache),
+                                                                   os.path.abspath(cache) + '.tmp')
+                   for cache in (self.hash_cache, self.map_cache)):
+                continue  # skip caches
             if not os.path.isfile(path):
                 continue  # skip directory
-            if os.path.getsize(path) == 0:
+            st = os.stat(path)
+            if st.st_size == 0:
                 continue  # skip empty file
-            infomap = [None, []]  # None as version number placeholder
-            self.file_blocks[name] = []
-            with open(path, 'rb') as f:
-                while True:
-                    block = f.read(self.block_size)
-                    if not block:
-                        break
-                    infomap[1].append(sha256(block).digest())
-                    self.file_blocks[name].append(block)
-            base_infos[name] = infomap
+            stats[name] = st
+            key = [st.st_size, st.st_mtime_ns, st.st_ino, self.chunker.params()]
+            if name in cache and cache[name][0] == key:
+                self.file_blocks[name] = [tuple(block) for block in cache[name][2]]
+                base_infos[name] = [None, cache[name][1]]  # None as version number placeholder
+            else:
+                # all files are hashed concurrently
+                hashing[name] = self.hash_ranges(path, st.st_size)
+        for name, futures in hashing.items():
+            base_infos[name], self.file_blocks[name] = [None, []], []
+            for future in futures:  # in file order
+                hashes, blocks = future.result()
+                base_infos[name][1].extend(hashes)
+                self.file_blocks[name].extend(blocks)
+        for name, st in stats.items():
+            for h, block in zip(base_infos[name][1], self.file_blocks[name]):
+                self.local_blocks.setdefault(h, (name, *block))
+            if st.st_mtime < racy_since:
+                new_cache[name] = [[st.st_size, st.st_mtime_ns, st.st_ino, self.chunker.params()],
+                                   base_infos[name][1], self.file_blocks[name]]
+        self.write_hash_cache(new_cache)
         return base_infos
 
+    def hash_ranges(self, path, size):
+        """
+        Split file of size into ranges of whole blocks and hash them in hash_pool
+        Content-defined blocks are only known by scanning from the start, such files are one range
+        :return: futures of ([blocks' hash], [(offset, length) of blocks]) of ranges in file order
+        """
+        if not isinstance(self.chunker, FixedChunker):
+            return [self.hash_pool.submit(self.hash_chunks, path)]
+        range_size = max(1, HASH_RANGE_SIZE // self.block_size) * self.block_size
+        return [self.hash_pool.submit(self.hash_range, path, start, min(start + range_size, size))
+                for start in range(0, size, range_size)]
+
+    def hash_range(self, path, start, stop):
+        """
+        Hash blocks of file in [start, stop), only one block is in memory at a time, run by hash_pool
+        :return: [blocks' hash], [(offset, length) of blocks]
+        """
+        hashes, blocks = [], []
+        with open(path, 'rb') as f:
+            f.seek(start)
+            offset = start
+            while offset < stop:
+                block = f.read(min(self.block_size, stop - offset))
+                if not block:
+                    break  # truncated after stat
+                hashes.append(sha256(block).digest())
+                blocks.append((offset, len(block)))
+                offset += len(block)
+        return hashes, blocks
+
+    def hash_chunks(self, path):
+        """
+        Hash blocks of file split by chunker, run by hash_pool
+        :return: [blocks' hash], [(offset, length) of blocks]
+        """
+        hashes, blocks = [], []
+        with open(path, 'rb') as f:
+            offset = 0
+            for block in self.chunker.chunks(f):
+                hashes.append(sha256(block).digest())
+                blocks.append((offset, len(block)))
+                offset += len(block)
+        return hashes, blocks
+
+    def read_hash_cache(self):
+        """
+        Read hash cache, invalid or missing cache is empty
+        :return: dict {file_name: [[size, mtime_ns, inode, chunker params], [blocks' hash], [(offset, length)]]}
+        """
+        if self.hash_cache is None or not os.path.exists(self.hash_cache):
+            return {}
+        try:
+            with open(self.hash_cache, 'rb') as f:
+                return codec.loads(f.read())
+        except Exception:  # truncated or not written by codec
+            print(f"ignore invalid hash cache {self.hash_cache}")
+            return {}
+
+    def write_hash_cache(self, cache):
+        if self.hash_cache is None:
+            return
+        with open(self.hash_cache + '.tmp', 'wb') as f:
+            f.write(codec.dumps(cache))
+        os.replace(self.hash_cache + '.tmp', self.hash_cache)  # a crash leaves the old or the new cache
+
+    def close(self):
+        """
+        Stop workers and close their server proxies
+        """
+        self.pool.shutdown()
+        self.hash_pool.shutdown()
+        self.worker_servers.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def get_fileinfomap(self):
         """
-        Get server's fileinfomap
+        Get server's fileinfomap, only entries changed since the last call are transferred
+        Get the whole map from servers not supporting getfileinfomap_since()
         :return: dict {file_name: [version, [blocks' hash]]}
         """
-        return self.server.getfileinfomap()
+        if self.remote_infos is None:
+            self.cursor, self.remote_infos = self.read_map_cache()
+        try:
+            cursor, whole, infos = self.read(lambda server: server.getfileinfomap_since(self.cursor), self.server)
+        except Exception as e:
+            print(f"getfileinfomap_since() failed, get the whole map: {e}")
+            self.cursor, self.remote_infos = 0, self.read(lambda server: server.getfileinfomap(), self.server)
+            return self.remote_infos
+        if whole:
+            self.remote_infos = {}
+        self.remote_infos.update(infos)
+        if self.map_cache is not None and (whole or infos):
+            with open(self.map_cache + '.tmp', 'wb') as f:
+                f.write(codec.dumps([cursor, self.remote_infos]))
+            os.replace(self.map_cache + '.tmp', self.map_cache)  # a crash leaves the old or the new cache
+        self.cursor = cursor
+        return self.remote_infos
+
+    def read_map_cache(self):
+        """
+        Read map cache, invalid or missing cache is empty
+        :return: cursor, server's fileinfomap as of cursor
+        """
+        if self.map_cache is None or not os.path.exists(self.map_cache):
+            return 0, {}
+        try:
+            with open(self.map_cache, 'rb') as f:
+                cursor, infos = codec.loads(f.read())
+            return cursor, infos
+        except Exception:  # truncated or not written by codec
+            print(f"ignore invalid map cache {self.map_cache}")
+            return 0, {}
 
     def update_index(self, local_infos):
         """
@@ -112,6 +614,7 @@ class SurfstoreClient:
         """
         Assume server and base do not change when running
         """
+        self.negotiate_compression()
         # file_info from base dir
         base_infos = self.scan_base()
         # file_info from index.html
@@ -153,14 +656,67 @@ class SurfstoreClient:
 
 def main():
     parser = argparse.ArgumentParser(description="SurfStore client")
-    parser.add_argument('hostport', help='host:port of the server')
+    parser.add_argument('hostport', help='host:port of the server, the server tried first with --config')
     parser.add_argument('basedir', help='The base directory')
-    parser.add_argument('blocksize', type=int, help='Block size')
+    parser.add_argument('blocksize', type=int, help='Block size, the average size with --chunking cdc')
+    parser.add_argument('--transport', choices=('xmlrpc', 'binary'), default='xmlrpc',
+                        help='RPC protocol, should be the same as the server')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='number of concurrent block transfers')
+    parser.add_argument('--hash-cache', default=None,
+                        help='file caching hashes of unchanged files between runs, every file is hashed by default')
+    parser.add_argument('--chunking', choices=('fixed', 'cdc'), default='fixed',
+                        help='split files at fixed offsets, or content-defined boundaries so that an insertion '
+                             'only changes nearby blocks, cdc scans files much slower, about 5-10 MB/s')
+    parser.add_argument('--min-block-size', type=int, default=None,
+                        help='min block size with --chunking cdc, a quarter of blocksize by default')
+    parser.add_argument('--max-block-size', type=int, default=None,
+                        help='max block size with --chunking cdc, 4 times blocksize by default')
+    parser.add_argument('--compression', choices=available(), default=None,
+                        help='compress blocks on the wire if the server supports it')
+    parser.add_argument('--map-cache', default=None,
+                        help="file keeping server's fileinfomap between runs, so that only changes are transferred")
+    parser.add_argument('--replication-factor', type=int, default=None,
+                        help='replication factor of servers sharding blocks, blocks are put to and read from '
+                             'their owners, requires --config')
+    parser.add_argument('--config', default=None,
+                        help='config file of the cluster, calls follow the leader and reads are spread over its '
+                             'servers if they serve follower reads, all calls go to hostport by default')
     args = parser.parse_args()
     print(args)
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.replication_factor is not None and args.config is None:
+        parser.error('--replication-factor requires --config')
+    chunker = None
+    if args.chunking == 'cdc':
+        min_size = args.min_block_size or max(args.blocksize // 4, 1)
+        max_size = args.max_block_size or args.blocksize * 4
+        if not 0 < min_size <= args.blocksize <= max_size:
+            parser.error('block sizes must be 0 < min <= blocksize <= max')
+        chunker = CDCChunker(min_size, args.blocksize, max_size)
+
+    def make_proxy(host, port):
+        # both keep a persistent connection per thread, workers can share them
+        if args.transport == 'binary':
+            return BinaryServerProxy(host, port)
+        return xmlrpc.client.ServerProxy(f'http://{host}:{port}', transport=TimeoutTransport(None))
 
-    with xmlrpc.client.ServerProxy(f'http://{args.hostport}', use_builtin_types=True) as proxy:
-        client = SurfstoreClient(proxy, args.basedir, args.blocksize)
+    host, port = args.hostport.rsplit(':', 1)
+    readers = ring = proxies = None
+    if args.config is None:
+        proxy = make_proxy(host, int(port))
+    else:
+        config_list = readconfig(args.config)[0]
+        ring = ring_of(config_list, args.replication_factor)  # named as in config, same as servers
+        server_list = [(socket.gethostbyname(h), p) for h, p in config_list]
+        address = socket.gethostbyname(host), int(port)
+        proxies = [make_proxy(h, p) for h, p in server_list]
+        proxy = ClusterProxy(proxies, server_list.index(address) if address in server_list else 0)
+        readers = [lambda p=p: p for p in proxies]
+    with proxy, SurfstoreClient(proxy, args.basedir, args.blocksize, args.workers, None,
+                                          args.hash_cache, chunker=chunker, compression=args.compression,
+                                          map_cache=args.map_cache, readers=readers, ring=ring,
+                                          block_servers=proxies) as client:
         client.run()
 
 
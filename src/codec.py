@@ -0,0 +1,96 @@
+import struct
+
+NONE, FALSE, TRUE, INT, FLOAT, BYTES, STR, LIST, DICT = range(9)
+
+TAG = struct.Struct('>B')
+INT64 = struct.Struct('>q')
+DOUBLE = struct.Struct('>d')
+LENGTH = struct.Struct('>I')
+
+
+def dumps(obj):
+    """
+    Serialize obj into compact tagged binary
+    Supports None, bool, int (64 bit), float, bytes, str, list, tuple and dict, tuples are decoded as lists
+    """
+    buf = bytearray()
+    _dump(obj, buf)
+    return bytes(buf)
+
+
+def _dump(obj, buf):
+    if obj is None:
+        buf += TAG.pack(NONE)
+    elif obj is True:
+        buf += TAG.pack(TRUE)
+    elif obj is False:
+        buf += TAG.pack(FALSE)
+    elif isinstance(obj, int):
+        buf += TAG.pack(INT) + INT64.pack(obj)
+    elif isinstance(obj, float):
+        buf += TAG.pack(FLOAT) + DOUBLE.pack(obj)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        buf += TAG.pack(BYTES) + LENGTH.pack(len(obj))
+        buf += obj
+    elif isinstance(obj, str):
+        data = obj.encode()
+        buf += TAG.pack(STR) + LENGTH.pack(len(data))
+        buf += data
+    elif isinstance(obj, (list, tuple)):
+        buf += TAG.pack(LIST) + LENGTH.pack(len(obj))
+        for item in obj:
+            _dump(item, buf)
+    elif isinstance(obj, dict):
+        buf += TAG.pack(DICT) + LENGTH.pack(len(obj))
+        for key, value in obj.items():
+            _dump(key, buf)
+            _dump(value, buf)
+    else:
+        raise TypeError(f"cannot serialize {type(obj).__name__}")
+
+
+def loads(data):
+    """Deserialize bytes produced by dumps"""
+    obj, offset = _load(memoryview(data), 0)
+    if offset != len(data):
+        raise ValueError("trailing data after serialized object")
+    return obj
+
+
+def _load(view, offset):
+    tag = view[offset]
+    offset += 1
+    if tag == NONE:
+        return None, offset
+    elif tag == TRUE:
+        return True, offset
+    elif tag == FALSE:
+        return False, offset
+    elif tag == INT:
+        return INT64.unpack_from(view, offset)[0], offset + INT64.size
+    elif tag == FLOAT:
+        return DOUBLE.unpack_from(view, offset)[0], offset + DOUBLE.size
+    elif tag in (BYTES, STR):
+        length = LENGTH.unpack_from(view, offset)[0]
+        offset += LENGTH.size
+        data = bytes(view[offset:offset + length])
+        if len(data) != length:
+            raise ValueError("truncated data")
+        return (data if tag == BYTES else data.decode()), offset + length
+    elif tag == LIST:
+        length = LENGTH.unpack_from(view, offset)[0]
+        offset += LENGTH.size
+        items = []
+        for _ in range(length):
+            item, offset = _load(view, offset)
+            items.append(item)
+        return items, offset
+    elif tag == DICT:
+        length = LENGTH.unpack_from(view, offset)[0]
+        offset += LENGTH.size
+        items = {}
+        for _ in range(length):
+            key, offset = _load(view, offset)
+            items[key], offset = _load(view, offset)
+        return items, offset
+    raise ValueError(f"unknown tag {tag}")
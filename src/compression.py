@@ -0,0 +1,50 @@
+import zlib
+
+try:
+    import lzma
+except ImportError:  # python built without liblzma
+    lzma = None
+
+# tag in the first byte of a compressed block
+RAW, ZLIB, LZMA = range(3)
+MIN_SAVING = 0.1  # keep block raw if compression saves less than this fraction
+SAMPLE_SIZE = 4096  # blocks larger than twice this are skipped if a sample of this size does not compress
+ZLIB_LEVEL = 6
+
+COMPRESSORS = {'zlib': (ZLIB, lambda b: zlib.compress(b, ZLIB_LEVEL))}  # {name: (tag, compress)}
+DECOMPRESSORS = {ZLIB: zlib.decompress}  # {tag: decompress}
+if lzma is not None:
+    COMPRESSORS['lzma'] = (LZMA, lzma.compress)
+    DECOMPRESSORS[LZMA] = lzma.decompress
+
+
+def available():
+    """Names of supported compressions"""
+    return list(COMPRESSORS)
+
+
+def compress(block, compression):
+    """
+    Compress block with one of available(), blocks that do not compress well are kept raw
+    :return: tag + payload
+    """
+    tag, func = COMPRESSORS[compression]
+    if len(block) > 2 * SAMPLE_SIZE and len(zlib.compress(block[:SAMPLE_SIZE], 1)) > SAMPLE_SIZE * (1 - MIN_SAVING):
+        return bytes([RAW]) + block  # likely incompressible, e.g. media or already compressed
+    payload = func(block)
+    if len(payload) > len(block) * (1 - MIN_SAVING):
+        return bytes([RAW]) + block
+    return bytes([tag]) + payload
+
+
+def decompress(data):
+    """Original block of data returned by compress()"""
+    if data[0] == RAW:
+        return data[1:]
+    if data[0] not in DECOMPRESSORS:
+        raise Exception(f"unsupported compression tag {data[0]}")
+    return DECOMPRESSORS[data[0]](data[1:])
+
+
+def tag_of(compression):
+    return COMPRESSORS[compression][0]
@@ -0,0 +1,49 @@
+import bisect
+from hashlib import sha256
+
+VNODES = 64  # points of each server on the ring, more points spread blocks more evenly
+
+
+class HashRing:
+    """
+    Consistent hashing of blocks onto servers by their SHA-256 hash
+    Each server has vnodes points on the ring at hashes of its name, a block is stored by the first replicas
+    distinct servers clockwise from its hash, so adding or removing a server only moves blocks it owns
+    """
+
+    def __init__(self, nodes, replicas, vnodes=VNODES):
+        """
+        :param nodes: names of servers indexed by server id, e.g. host:port in the config file
+        :param replicas: number of servers storing each block, all servers if there are fewer
+        """
+        assert replicas > 0, "Replication factor must be positive"
+        self.nodes = nodes
+        self.replicas = min(replicas, len(nodes))
+        points = sorted((int.from_bytes(sha256(f'{node}#{i}'.encode()).digest()[:8], 'big'), server_id)
+                        for server_id, node in enumerate(nodes) for i in range(vnodes))
+        self.keys = [key for key, _ in points]
+        self.ids = [server_id for _, server_id in points]
+
+    def owners(self, h):
+        """
+        Ids of servers storing the block of hash h, the first one is its primary
+        """
+        start = bisect.bisect(self.keys, int.from_bytes(h[:8], 'big'))  # hashes are uniform already
+        owners = []
+        for i in range(start, start + len(self.ids)):
+            server_id = self.ids[i % len(self.ids)]
+            if server_id not in owners:
+                owners.append(server_id)
+                if len(owners) == self.replicas:
+                    break
+        return owners
+
+    def group(self, hashes):
+        """
+        Group hashes by primary owner
+        :return: {server id: [indexes of hashes]}
+        """
+        groups = {}
+        for i, h in enumerate(hashes):
+            groups.setdefault(self.owners(h)[0], []).append(i)
+        return groups
@@ -0,0 +1,143 @@
+import socket
+import struct
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from threading import local
+
+import codec
+
+FRAME_HEADER = struct.Struct('>I')  # length of the frame payload
+MAX_FRAME_SIZE = 1 << 30
+
+
+class RPCError(Exception):
+    """Exception raised by the remote method, message has the same format as xmlrpc.client.Fault.faultString"""
+    pass
+
+
+def read_frame(rfile):
+    """
+    Read a length-prefixed frame from a binary file object
+    :return: deserialized payload, None if the connection is closed before a new frame
+    """
+    header = rfile.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) != FRAME_HEADER.size:
+        raise ConnectionError("connection closed in frame header")
+    length = FRAME_HEADER.unpack(header)[0]
+    if length > MAX_FRAME_SIZE:
+        raise ConnectionError(f"frame of {length} bytes is too large")
+    payload = rfile.read(length)
+    if len(payload) != length:
+        raise ConnectionError("connection closed in frame payload")
+    return codec.loads(payload)
+
+
+def write_frame(wfile, obj):
+    payload = codec.dumps(obj)
+    wfile.write(FRAME_HEADER.pack(len(payload)) + payload)
+    wfile.flush()
+
+
+class BinaryRequestHandler(StreamRequestHandler):
+    """
+    Serve requests [method, params] on a persistent connection until the client closes it
+    Reply [True, result] on success or [False, error message] if the method raises
+    """
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        while True:
+            try:
+                request = read_frame(self.rfile)
+            except (OSError, ValueError):
+                return
+            if request is None:
+                return
+            method, params = request
+            try:
+                response = [True, self.server.instance._dispatch(method, params)]
+            except Exception as e:
+                response = [False, f'{type(e)}:{e}']
+            try:
+                write_frame(self.wfile, response)
+            except OSError:
+                return
+
+
+class BinaryRPCServer(ThreadingTCPServer):
+    """
+    Length-prefixed binary RPC server, a drop-in alternative to SimpleXMLRPCServer
+    Each connection is served by one thread, clients keep connections open between calls
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, addr):
+        super().__init__(addr, BinaryRequestHandler)
+        self.instance = None
+
+    def register_instance(self, instance):
+        """instance should implement _dispatch(method, params)"""
+        self.instance = instance
+
+
+class BinaryServerProxy:
+    """
+    Client of BinaryRPCServer, used like xmlrpc.client.ServerProxy
+    Keeps one persistent connection per thread, reconnects after a connection error
+    Connection errors raise OSError, exceptions of the remote method raise RPCError
+    """
+
+    def __init__(self, host, port, timeout=None):
+        self.address = host, port
+        self.timeout = timeout
+        self._local = local()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*params):
+            return self._call(name, params)
+
+        return call
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._local.connection = sock, sock.makefile('rb'), sock.makefile('wb')
+        return self._local.connection
+
+    def _call(self, method, params):
+        connection = getattr(self._local, 'connection', None) or self._connect()
+        try:
+            write_frame(connection[2], [method, list(params)])
+            response = read_frame(connection[1])
+            if response is None:
+                raise ConnectionError("connection closed by server")
+        except (OSError, ValueError) as e:
+            self._close()
+            if isinstance(e, OSError):
+                raise
+            raise ConnectionError(f"bad response: {e}") from e
+        successful, result = response
+        if not successful:
+            raise RPCError(result)
+        return result
+
+    def _close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection:
+            self._local.connection = None
+            for f in reversed(connection):
+                f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._close()
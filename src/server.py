@@ -1,68 +1,230 @@
 import argparse
 import http.client
 import socket
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from hashlib import sha256
 from socketserver import ThreadingMixIn
-from threading import Lock
+from threading import Condition, Lock, Thread, local
 from xmlrpc.client import ServerProxy, Transport
 from xmlrpc.server import SimpleXMLRPCRequestHandler
 from xmlrpc.server import SimpleXMLRPCServer
 
-from state import State, Follower, Leader
+import codec
+from aioserver import AsyncRPCServer
+from blockstore import DiskBlockStore
+from compression import available, decompress
+from ring import HashRing
+from rpc import BinaryRPCServer, BinaryServerProxy
+from state import ELECTION_TIMEOUT, State, Follower, Leader
 from surfstore import SurfStore
+from wal import WriteAheadLog
+
+
+SNAPSHOT_THRESHOLD = 1000  # take a snapshot when this many logs are applied since the last one
+PEER_TIMEOUT = 0.01  # socket timeout of RPCs between servers
+WAL_PEER_TIMEOUT = 0.1  # socket timeout of RPCs between servers with a write-ahead log, followers fsync before replying
+# socket timeout of readIndex and block RPCs between servers, they wait for a round of heartbeats or carry MBs
+BULK_TIMEOUT = 5
+PUSH_WORKERS = 16  # threads of a leader pushing blocks to followers
+REPAIR_INTERVAL = 1  # seconds between pulls of blocks missing on a server
+TRANSPORTS = ('xmlrpc', 'binary')
+# how leaders confirm they are still leader before serving reads, should be the same on all servers
+# readindex: one round of heartbeats for each read, lease: no RPCs while a majority acknowledged recently
+READ_MODES = ('readindex', 'lease')
+# how followers serve reads of fileinfomap, off: only the leader serves them
+# readindex: wait until the follower applied the commit_index confirmed by the leader, linearizable
+# stale: serve local state if the follower heard from a leader within max_staleness seconds
+FOLLOWER_READS = ('off', 'readindex', 'stale')
+MAX_STALENESS = 1  # seconds
 
 
 class RequestHandler(SimpleXMLRPCRequestHandler):
     rpc_paths = ('/RPC2',)
+    protocol_version = 'HTTP/1.1'  # keep connections alive, HTTP/1.0 closes them after each call
 
 
 class ThreadedXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
-    pass
+    daemon_threads = True  # threads of idle keep-alive connections do not block server_close()
 
 
 class TimeoutTransport(Transport):
-    def __init__(self):
+    def __init__(self, timeout=PEER_TIMEOUT):
         super().__init__(False, True)
+        self.timeout = timeout
+        self._local = local()  # one connection per thread, replicators and voters call the same proxy concurrently
 
     def make_connection(self, host):
-        if self._connection and host == self._connection[0]:
-            return self._connection[1]
+        connection = getattr(self._local, 'connection', None)
+        if connection and host == connection[0]:
+            return connection[1]
         # create a HTTP connection object from a host descriptor
         chost, self._extra_headers, x509 = self.get_host_info(host)
-        self._connection = host, http.client.HTTPConnection(chost, timeout=0.01)
-        return self._connection[1]
+        self._local.connection = host, http.client.HTTPConnection(chost, timeout=self.timeout)
+        return self._local.connection[1]
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection:
+            self._local.connection = None
+            connection[1].close()
 
 
 class SurfstoreServer:
-    def __init__(self, proxies, id, num_servers):
-        self.surfstore = SurfStore()
+    def __init__(self, proxies, id, num_servers, commit_timeout=None, wal_dir=None, block_dir=None,
+                 compression=None, read_mode='readindex', follower_reads='off', max_staleness=MAX_STALENESS,
+                 ring=None):
+        self.wal = None  # WriteAheadLog, None as in memory only
+        self.unsynced = deque()  # [(WAL record seq, last log index of the record)] appended but maybe not fsynced
+        self.synced_index = 0  # last log index known to be fsynced
+        # blocks are replicated outside of Raft log, by push_blocks() of the leader and repair_blocks() of each server
+        self.ring = ring  # HashRing placing blocks on some servers in the same order as proxies, on all if None
+        self.surfstore = SurfStore(DiskBlockStore(block_dir) if block_dir is not None else None, compression)
         self.file_info_lock = Lock()
         self.num_servers = num_servers  # num_servers is known even when proxies is None
         self.proxies = proxies
         self.id = id
         self.current_term = 0
         self.voted_for = None  # None as null
-        self.logs = []  # [(term, cmd)], 1-indexed in paper
+        self.logs = []  # [(term, cmd)] after snapshot_index, 1-indexed in paper
         self.commit_index = 0
         self.last_applied = 0
+        self.snapshot_index = 0  # index of the last log compacted into snapshot
+        self.snapshot_term = 0
+        self.snapshot = None  # serialized surfstore.snapshot() at snapshot_index
+        self.snapshot_threshold = SNAPSHOT_THRESHOLD
+        self.snapshot_chunks = None  # chunks of the snapshot being installed
+        self.snapshot_thread = None  # runs take_snapshot(), one snapshot is taken at a time
         self.lock = Lock()
-        # self.time_out = CHECK_TIMEOUT
-        self.num_up = 1
+        # notified when commit_index, acknowledgements of AppendEntries or state changes,
+        # waiters sleep instead of spinning
+        self.commit_cond = Condition(self.lock)
+        self.commit_timeout = commit_timeout  # seconds to wait for commit, None as forever
+        self.apply_results = {}  # {log index: (term, result of surfstore.updatefile)}, only for indexes being waited
+        self.read_mode = read_mode  # one of READ_MODES
+        self.leader_seen = 0  # time.monotonic() of the last AppendEntries accepted from a leader
+        self.leader_id = None  # leader of current_term, None if unknown
+        self.follower_reads = follower_reads  # one of FOLLOWER_READS
+        self.max_staleness = max_staleness
+        self.bulk_proxies = None  # proxies for readIndex and block RPCs with a longer timeout, use proxies if None
+        self.read_index_lock = Lock()  # one readIndex in flight, concurrent reads share its result
+        self.last_read_index = 0, 0  # time.monotonic() the last readIndex was sent, its result
+        self.push_pool = ThreadPoolExecutor(PUSH_WORKERS, thread_name_prefix='push')
+        # hashes referenced by applied file infos but not stored here, locked by file_info_lock
+        self.missing_blocks = set()
+        self.repair_thread = None  # runs repair_blocks() until crashed
         self.is_crashed = True
         self.state: State = None
+        if wal_dir is not None:
+            self.recover(wal_dir)
         self.crash()  # crashed by default
 
+    @property
+    def current_term(self):
+        return self._current_term
+
+    @current_term.setter
+    def current_term(self, term):
+        self._current_term = term
+        if self.wal is not None:
+            self.wal.set_hard_state(term, self._voted_for)
+
+    @property
+    def voted_for(self):
+        return self._voted_for
+
+    @voted_for.setter
+    def voted_for(self, candidate_id):
+        self._voted_for = candidate_id
+        if self.wal is not None:
+            self.wal.set_hard_state(self._current_term, candidate_id)
+
+    def recover(self, wal_dir):
+        """
+        Rebuild current_term, voted_for, logs and the state machine from the write-ahead log in wal_dir
+        """
+        wal = WriteAheadLog(wal_dir)
+        self.current_term, self.voted_for, snapshot, self.logs, self.commit_index = wal.recover()
+        if snapshot is not None:
+            self.snapshot_index, self.snapshot_term, self.snapshot = snapshot
+            self.surfstore.restore(codec.loads(self.snapshot))
+            self.find_missing_blocks()
+            self.last_applied = self.snapshot_index
+        with self.lock:
+            self.apply_committed()
+        self.wal = wal
+        self.synced_index = self.last_log_index()
+        print(f'{self.id} {self.current_term} {self.state} recover(): {self.last_log_index()} logs, '
+              f'{self.snapshot_index} in snapshot, {self.commit_index} committed')
+
+    def last_log_index(self):
+        return self.snapshot_index + len(self.logs)
+
+    def log_entry(self, index):
+        """
+        Log entry (term, cmd) at index, index should be after snapshot_index
+        """
+        return self.logs[index - self.snapshot_index - 1]
+
+    def log_term(self, index):
+        """
+        Term of log at index, index should be at least snapshot_index, term of index 0 is 0
+        """
+        return self.snapshot_term if index == self.snapshot_index else self.log_entry(index)[0]
+
+    def log_entries(self, start, stop=None):
+        """
+        Log entries with index in [start, stop), start should be after snapshot_index
+        """
+        offset = self.snapshot_index + 1
+        return self.logs[start - offset:None if stop is None else stop - offset]
+
+    def append_to_wal(self, index, entries):
+        """
+        Write log entries starting at index to the write-ahead log, they are durable after the next sync
+        Assume calling thread acquired self.lock
+        """
+        self.unsynced.append((self.wal.append_entries(index, entries), index + len(entries) - 1))
+
+    def durable_index(self):
+        """
+        Last log index that survives a crash, the leader counts only durable logs of its own toward a majority
+        Assume calling thread acquired self.lock
+        """
+        if self.wal is None:
+            return self.last_log_index()
+        while self.unsynced and self.unsynced[0][0] <= self.wal.synced:
+            self.synced_index = self.unsynced.popleft()[1]
+        return min(self.synced_index, self.last_log_index())
+
+    def sync(self):
+        """
+        Make Raft state durable, called before replying to or sending RPCs
+        Should not be called with self.lock acquired, concurrent callers share one fsync
+        """
+        if self.wal is not None:
+            self.wal.sync()
+
     def _dispatch(self, method, params):
         # workaround for autograder call methods as surfstore.*
         func_name = method.split(".")[-1]
         return getattr(self, func_name)(*params)
 
     @staticmethod
-    def set_up_connections(server_list, id):
+    def set_up_connections(server_list, id, transport='xmlrpc', timeout=PEER_TIMEOUT):
+        """
+        Create proxies of other servers, transport should be the same on all servers, one of TRANSPORTS
+        :param timeout: socket timeout of RPCs in seconds
+        """
         proxies = {}
         for server_id, (host, port) in enumerate(server_list):
             if server_id != id:  # remove itself
                 host = socket.gethostbyname(host)  # localhost is slow on Windows
-                proxies[server_id] = ServerProxy(f'http://{host}:{port}', transport=TimeoutTransport())
+                if transport == 'binary':
+                    proxies[server_id] = BinaryServerProxy(host, port, timeout=timeout)
+                else:
+                    proxies[server_id] = ServerProxy(f'http://{host}:{port}', transport=TimeoutTransport(timeout))
         return proxies
 
     def transit_state(self, StateClass):
@@ -72,6 +234,7 @@ class SurfstoreServer:
         """
         if self.state is not None:
             self.state.stop()
+        self.commit_cond.notify_all()  # wake up waiters to check leadership
 
         if StateClass is None:
             self.state = None
@@ -108,6 +271,9 @@ class SurfstoreServer:
         with self.lock:
             self.is_crashed = False
             self.transit_state(Follower)
+            if self.repair_thread is None or not self.repair_thread.is_alive():
+                self.repair_thread = Thread(target=self.repair_blocks, daemon=True)
+                self.repair_thread.start()
         return True
 
     def isCrashed(self):
@@ -122,56 +288,126 @@ class SurfstoreServer:
         """
         Requests vote from this server to become the leader
         """
-        if not self.lock.acquire(blocking=False):
-            return -1, False
-        if self.is_crashed:
-            self.lock.release()
-            return -1, False
-        self.state.on_RequestVote()
-        print(f'{self.id} {self.current_term} {self.state} requestVote(): from {candidate_id}')
-        if not self.__check_term(term):
-            self.lock.release()
-            return self.current_term, False
-        # If votedFor is null or candidateId, and candidate’s log is at
-        # least as up-to-date as receiver’s log, grant vote
-        is_leader = self.voted_for is None or self.voted_for == candidate_id
-        up_to_date = (self.logs[-1][0] if self.logs else 0, len(self.logs)) <= (log_term, log_index)
-        vote_granted = is_leader and up_to_date
-        if vote_granted:
-            self.voted_for = candidate_id
-            print(f'{self.id} {self.current_term} {self.state} requestVote(): voted for {self.voted_for}')
-        self.lock.release()
-        return term, vote_granted
-
-    def appendEntries(self, term, prev_index, prev_term, entries, leader_commit):
-        """Updates fileinfomap to match that of the leader"""
-        if not self.lock.acquire(blocking=False):
-            return -1, False  # TODO: avoid deadlock by presumably crashed
-        if self.is_crashed:
-            self.lock.release()
-            return -1, False
-        self.state.on_AppendEntries()
-        if not self.__check_term(term):
-            self.lock.release()
-            return self.current_term, False
-        if entries:
-            if len(self.logs) < prev_index or (prev_index > 0 and self.logs[prev_index - 1][0] != prev_term):
-                return self.current_term, False
-            for index, entry in enumerate(entries, prev_index):
-                if index < len(self.logs) and self.logs[index][0] != entry[0]:
-                    del self.logs[index:]  # if conflicts, delete
-                    break
-            self.logs[prev_index:] = entries  # append new entries
-
-        if leader_commit > self.commit_index:
-            self.commit_index = min(leader_commit, len(self.logs))
-        # apply committed cmds, commit_index and last_applied are log entry index, both of them are 1-indexed
-        if self.commit_index > self.last_applied:
-            for idx in range(self.last_applied, self.commit_index):
-                self.surfstore.updatefile(*self.logs[idx][1])
-            self.last_applied = self.commit_index
-        self.lock.release()
-        return self.current_term, True
+        try:
+            with self.lock:
+                if self.is_crashed:
+                    return -1, False
+                self.state.on_RequestVote()
+                print(f'{self.id} {self.current_term} {self.state} requestVote(): from {candidate_id}')
+                if self.read_mode == 'lease' and term > self.current_term and \
+                        (self.isLeader() or time.monotonic() - self.leader_seen < ELECTION_TIMEOUT[0]):
+                    # the leader may hold a lease, don't help electing another one or step down until it expires
+                    return self.current_term, False
+                if not self.__check_term(term):
+                    return self.current_term, False
+                # If votedFor is null or candidateId, and candidate’s log is at
+                # least as up-to-date as receiver’s log, grant vote
+                is_leader = self.voted_for is None or self.voted_for == candidate_id
+                up_to_date = (self.log_term(self.last_log_index()), self.last_log_index()) <= (log_term, log_index)
+                vote_granted = is_leader and up_to_date
+                if vote_granted:
+                    self.voted_for = candidate_id
+                    print(f'{self.id} {self.current_term} {self.state} requestVote(): voted for {self.voted_for}')
+                return term, vote_granted
+        finally:
+            self.sync()  # persist term and vote before reply, after releasing self.lock
+
+    def appendEntries(self, term, prev_index, prev_term, entries, leader_commit, leader_id=None):
+        """
+        Updates fileinfomap to match that of the leader
+        :param leader_id: id of the leader, followers redirect readIndex to it
+        :return: term, successful, conflict_index, conflict_term
+                 conflict hints are 0 unless rejected due to log inconsistency, conflict_term is 0 if the log at
+                 prev_index is missing, otherwise it is the term at prev_index and conflict_index is its first log
+        """
+        # no server holds its lock while sending RPCs, so blocking here can not dead lock
+        try:
+            with self.lock:
+                if self.is_crashed:
+                    return -1, False, 0, 0
+                self.state.on_AppendEntries()
+                if not self.__check_term(term):
+                    return self.current_term, False, 0, 0
+                self.leader_seen = time.monotonic()
+                self.leader_id = leader_id
+                # heartbeats are checked as well, the leader relies on success to update match_index
+                if self.last_log_index() < prev_index:
+                    return self.current_term, False, self.last_log_index() + 1, 0
+                last_new_index = prev_index + len(entries)
+                if prev_index < self.snapshot_index:
+                    # entries in snapshot are committed so they must match, skip them
+                    entries = entries[self.snapshot_index - prev_index:]
+                    prev_index = self.snapshot_index
+                elif self.log_term(prev_index) != prev_term:
+                    conflict_term = self.log_term(prev_index)
+                    conflict_index = prev_index
+                    while conflict_index - 1 > self.snapshot_index and \
+                            self.log_term(conflict_index - 1) == conflict_term:
+                        conflict_index -= 1
+                    return self.current_term, False, conflict_index, conflict_term
+                # pipelined AppendEntries may arrive out of order, keep matching entries after the new ones
+                new_entries = []
+                for index, entry in enumerate(entries, prev_index + 1):
+                    if index <= self.last_log_index():
+                        if self.log_term(index) == entry[0]:
+                            continue
+                        del self.logs[index - self.snapshot_index - 1:]  # if conflicts, delete
+                        # records of deleted logs no longer make logs up to their index durable
+                        self.synced_index = min(self.synced_index, index - 1)
+                        self.unsynced = deque((seq, min(last, index - 1)) for seq, last in self.unsynced)
+                    self.logs.append(entry)  # append new entries
+                    new_entries.append(entry)
+                if new_entries and self.wal is not None:
+                    self.append_to_wal(self.last_log_index() - len(new_entries) + 1, new_entries)
+
+                if leader_commit > self.commit_index:
+                    # only entries matching the leader's log up to the last new entry can be committed
+                    self.commit_index = max(self.commit_index, min(leader_commit, last_new_index))
+                self.apply_committed()
+                return self.current_term, True, 0, 0
+        finally:
+            self.sync()  # persist logs before reply, after releasing self.lock
+
+    def installSnapshot(self, term, last_index, last_term, offset, data, done):
+        """
+        Receives a chunk of the leader's snapshot, the snapshot replaces logs and fileinfomap when done
+        Chunks are sent in order, successful is False if a chunk is missing and the leader should start over
+        """
+        try:
+            with self.lock:
+                if self.is_crashed:
+                    return -1, False
+                self.state.on_AppendEntries()
+                if not self.__check_term(term):
+                    return self.current_term, False
+                if offset == 0:
+                    self.snapshot_chunks = bytearray()
+                elif self.snapshot_chunks is None or len(self.snapshot_chunks) != offset:
+                    return self.current_term, False
+                self.snapshot_chunks += data
+                if not done:
+                    return self.current_term, True
+                data, self.snapshot_chunks = bytes(self.snapshot_chunks), None
+            # decode and persist a large snapshot without blocking heartbeats
+            state = codec.loads(data)
+            if self.wal is not None:
+                self.wal.write_snapshot(last_index, last_term, data)
+            with self.lock:
+                if self.is_crashed:
+                    return -1, False
+                print(f'{self.id} {self.current_term} {self.state} installSnapshot(): up to {last_index}')
+                if last_index > self.last_applied:
+                    with self.file_info_lock:
+                        self.surfstore.restore(state)
+                        self.find_missing_blocks()
+                    self.last_applied = last_index
+                    self.commit_index = max(self.commit_index, last_index)
+                if last_index > self.snapshot_index:
+                    self.compact(last_index, last_term, data)
+                self.apply_committed()
+                return self.current_term, True
+        finally:
+            self.sync()
 
     def __check_term(self, term):
         """
@@ -181,32 +417,357 @@ class SurfstoreServer:
             return False
         elif term > self.current_term:
             self.current_term = term
+            self.leader_id = None
             # If a candidate or leader discovers that its term is out of date, reverts to follower state.
             self.voted_for = None
             self.transit_state(Follower)
         return True
 
-    def getfileinfomap(self):
-        # contact majority of nodes before reply to readonly request
-        while self.isLeader() and self.num_up < self.num_servers // 2 + 1:
-            pass
-        if self.isLeader():
+    def apply_committed(self):
+        """
+        Apply committed cmds to surfstore in log order and wake up waiters
+        Take a snapshot if enough logs are applied since the last one
+        Assume calling thread acquired self.lock
+        """
+        # commit_index and last_applied are log entry index, both of them are 1-indexed
+        if self.commit_index > self.last_applied:
+            with self.file_info_lock:
+                for index in range(self.last_applied + 1, self.commit_index + 1):
+                    term, cmd = self.log_entry(index)
+                    if not cmd:
+                        continue  # no-op of a new leader
+                    result = self.surfstore.updatefile(*cmd)
+                    if result:
+                        self.missing_blocks.update(h for h in cmd[2]
+                                                   if h not in self.surfstore.blocks and self.owns(h))
+                    if index in self.apply_results:
+                        self.apply_results[index] = term, result
+            self.last_applied = self.commit_index
+            if self.wal is not None:
+                self.wal.set_commit_index(self.commit_index)
+            self.commit_cond.notify_all()
+        if self.last_applied > self.snapshot_index and \
+                self.last_applied - self.snapshot_index >= self.snapshot_threshold and \
+                (self.snapshot_thread is None or not self.snapshot_thread.is_alive()):
             with self.file_info_lock:
-                return self.surfstore.getfileinfomap()
-        raise Exception("isCrashed or is not Leader")
+                state = self.surfstore.snapshot()
+            self.snapshot_thread = Thread(target=self.take_snapshot,
+                                          args=(self.last_applied, self.log_term(self.last_applied), state),
+                                          daemon=True)
+            self.snapshot_thread.start()
+
+    def take_snapshot(self, index, term, state):
+        """
+        Serialize and persist state of surfstore at index, then compact logs up to index
+        Runs without self.lock except for compaction, so large snapshots do not block RPCs
+        """
+        data = codec.dumps(state)
+        if self.wal is not None:
+            self.wal.write_snapshot(index, term, data)
+        with self.lock:
+            if index > self.snapshot_index:
+                self.compact(index, term, data)
+
+    def compact(self, index, term, data):
+        """
+        Replace logs up to index by snapshot data, logs after index are kept if log at index matches term
+        The snapshot should be written to the write-ahead log by wal.write_snapshot() already
+        Assume calling thread acquired self.lock
+        """
+        if index <= self.last_log_index() and self.log_term(index) == term:
+            del self.logs[:index - self.snapshot_index]
+        else:
+            self.logs = []
+        self.snapshot_index, self.snapshot_term, self.snapshot = index, term, data
+        if self.wal is not None:
+            self.wal.compact(index, self.current_term, self.voted_for, self.logs, self.commit_index)
+            self.synced_index = max(self.synced_index, index)
+        print(f'{self.id} {self.current_term} {self.state} compact(): up to {index}')
+
+    def getblock(self, h):
+        if self.isCrashed():
+            raise Exception("isCrashed")
+        self.pull_blocks([h])
+        return self.surfstore.getblock(h)
+
+    def putblock(self, b):
+        return self.putblocks([b])
+
+    def getcompressions(self):
+        return self.surfstore.getcompressions()
+
+    def getblocks(self, hashes, compression=None):
+        if self.isCrashed():
+            raise Exception("isCrashed")  # before pulling, crashed servers send no RPCs
+        self.pull_blocks(hashes)
+        return self.surfstore.getblocks(hashes, compression)
+
+    def putblocks(self, blocks, compressed=False):
+        """
+        Store blocks on their owners, return once a majority of owners of each block stores it
+        Without a ring, only the leader accepts blocks and all servers own them
+        With a ring, any server accepts blocks, clients put them to their primary owners
+        """
+        if self.ring is None:
+            self.check_leader()
+            owners = [range(self.num_servers)] * len(blocks)
+        else:
+            if self.isCrashed():
+                raise Exception("isCrashed")
+            owners = [self.ring.owners(sha256(decompress(b) if compressed else b).digest()) for b in blocks]
+        result = self.surfstore.putblocks([b for b, o in zip(blocks, owners) if self.id in o], compressed)
+        self.push_blocks(blocks, compressed, owners)
+        return result
+
+    def hasblocks(self, blocklist):
+        """
+        Blocks stored on this server, clients ask the leader, or primary owners with a ring
+        """
+        if self.ring is None:
+            self.check_leader()
+        elif self.isCrashed():
+            raise Exception("isCrashed")
+        return self.surfstore.hasblocks(blocklist)
+
+    def check_leader(self):
+        """
+        Without a ring, only the leader accepts blocks from clients and tells which blocks it has
+        """
+        with self.lock:
+            if not self.isLeader():
+                raise self.not_leader()
+
+    def owns(self, h):
+        """Whether this server stores the block of hash h"""
+        return self.ring is None or self.id in self.ring.owners(h)
+
+    def push_blocks(self, blocks, compressed, owners):
+        """
+        Push blocks to their other owners, return once a majority of owners of each block stores it
+        A file referring to them commits afterwards, so any majority of owners has a copy
+        Without a ring, any majority of servers including a new leader has a copy
+        :param owners: ids of owners of each block
+        """
+        proxies = self.bulk_proxies or self.proxies
+        pushes = {}  # {server_id: [indexes of blocks]}
+        for i, block_owners in enumerate(owners):
+            for server_id in block_owners:
+                if server_id != self.id and server_id in proxies:
+                    pushes.setdefault(server_id, []).append(i)
+        futures = {self.push_pool.submit(proxies[server_id].pushBlocks, [blocks[i] for i in indexes], compressed):
+                   indexes for server_id, indexes in pushes.items()}
+        needed = [len(o) // 2 + 1 - (self.id in o) for o in owners]  # more owners to store each block
+        replies = as_completed(futures, self.commit_timeout)
+        try:
+            while any(n > 0 for n in needed):
+                future = next(replies)
+                if future.exception() is None:
+                    for i in futures[future]:
+                        needed[i] -= 1
+        except (StopIteration, TimeoutError):
+            # the others may still store them, then repair_blocks() pulls them from anyone having a copy
+            raise Exception(f"{sum(n > 0 for n in needed)} blocks are stored on less than majority of owners")
+
+    def pushBlocks(self, blocks, compressed=False):
+        """
+        Store blocks pushed by the server they were put to, this server owns them
+        """
+        if self.isCrashed():
+            raise Exception("isCrashed")
+        return self.surfstore.putblocks(blocks, compressed)
+
+    def pullBlocks(self, hashes):
+        """
+        Get blocks of hashes stored on this server for servers missing them
+        :return: [[hash, block]] of a prefix of stored blocks at most MAX_BATCH_BYTES in total, empty if none
+        """
+        if self.isCrashed():
+            raise Exception("isCrashed")
+        stored = [h for h in hashes if h in self.surfstore.blocks]
+        return [[h, b] for h, b in zip(stored, self.surfstore.getblocks(stored))] if stored else []
+
+    def pull_blocks(self, hashes):
+        """
+        Pull blocks of hashes not stored on this server from other servers, their owners then the leader first
+        Blocks pulled are kept, a server not owning them serves them again without pulling
+        :return: hashes still missing
+        """
+        missing = [h for h in hashes if h not in self.surfstore.blocks]
+        if not missing:
+            return missing
+        proxies = self.bulk_proxies or self.proxies
+        with self.lock:
+            leader_id = self.leader_id
+        order = {}  # {server_id: order of owners}
+        if self.ring is not None:
+            for h in missing:
+                for server_id in self.ring.owners(h):
+                    order.setdefault(server_id, len(order))
+        for server_id in sorted(proxies, key=lambda i: (order.get(i, len(order)), i != leader_id)):
+            try:
+                while missing:
+                    pulled = proxies[server_id].pullBlocks(missing)
+                    self.surfstore.putblocks([b for _, b in pulled])  # hashed again, stored by their content
+                    left = [h for h in missing if h not in self.surfstore.blocks]
+                    if len(left) == len(missing):
+                        break  # the server has none of the rest
+                    missing = left
+            except Exception as e:
+                print(f'{self.id} pull_blocks(): from {server_id} failed: {e}')
+            if not missing:
+                break
+        return missing
+
+    def find_missing_blocks(self):
+        """
+        Find blocks of all files owned but not stored by this server after the state machine is restored
+        With a ring, a server restarted with a changed server list pulls blocks it owns now
+        Assume calling thread acquired self.file_info_lock
+        """
+        self.missing_blocks = {h for _, hashes in self.surfstore.file_infos.values() for h in hashes
+                               if h not in self.surfstore.blocks and self.owns(h)}
+
+    def repair_blocks(self):
+        """
+        Pull blocks of applied files that are missing on this server every REPAIR_INTERVAL until crashed
+        Followers that missed pushes of the leader, e.g. crashed or slow ones, catch up in the background
+        """
+        while not self.isCrashed():
+            time.sleep(REPAIR_INTERVAL)
+            with self.file_info_lock:
+                missing = list(self.missing_blocks)
+            if not missing:
+                continue
+            left = set(self.pull_blocks(missing))
+            with self.file_info_lock:
+                self.missing_blocks.difference_update(h for h in missing if h not in left)
+            if left:
+                print(f'{self.id} repair_blocks(): {len(left)} blocks are missing')
+
+    def not_leader(self):
+        """
+        Exception of requests only the leader serves, with the leader's id as a hint if this server knows it
+        Assume calling thread acquired self.lock
+        """
+        if self.is_crashed or self.leader_id is None or self.leader_id == self.id:
+            return Exception("isCrashed or is not Leader")
+        return Exception(f"isCrashed or is not Leader, leader is {self.leader_id}")
+
+    def check_read(self):
+        """
+        Wait until a linearizable read can be served from the state machine of this leader, raise if it can not
+        ReadIndex: the leader commits an entry of its term, records commit_index, then confirms it is still leader
+        by a round of heartbeats, entries up to the recorded commit_index are applied on commit by the leader
+        With lease reads, the heartbeat round is skipped while the lease is valid
+        Assume calling thread acquired self.lock
+        """
+        if not self.isLeader():
+            raise self.not_leader()
+        state, term = self.state, self.current_term
+        if self.log_term(self.commit_index) != term:
+            # commit_index of a new leader may be behind, it is known once an entry of its term commits
+            if self.log_term(self.last_log_index()) != term:
+                self.logs.append((term, []))  # no-op
+                if self.wal is not None:
+                    self.append_to_wal(self.last_log_index(), [self.logs[-1]])
+                    self.wal.sync()  # rare, once per term
+                self.state.notify()
+            if not self.commit_cond.wait_for(
+                    lambda: self.state is not state or self.log_term(self.commit_index) == term, self.commit_timeout):
+                raise Exception("timed out waiting for commit in the current term")
+        if self.state is state and not (self.read_mode == 'lease' and state.lease_valid()):
+            read_seq = state.confirm_leadership()
+            if not self.commit_cond.wait_for(lambda: self.state is not state or state.confirmed(read_seq),
+                                             self.commit_timeout):
+                raise Exception("timed out waiting for majority of servers")
+        if self.state is not state:
+            raise self.not_leader()
+
+    def readIndex(self):
+        """
+        Confirm leadership for a read served by a follower
+        :return: commit_index the follower should apply before serving the read
+        """
+        with self.lock:
+            self.check_read()
+            return self.commit_index
+
+    def wait_readable(self):
+        """
+        Wait until fileinfomap can be read from this server, raise if it can not
+        Leaders serve reads after check_read(), followers serve them as configured by follower_reads
+        """
+        with self.lock:
+            if self.is_crashed or (not self.isLeader() and self.follower_reads == 'off'):
+                raise self.not_leader()
+            if self.isLeader():
+                self.check_read()
+                return
+            if self.follower_reads == 'stale':
+                if time.monotonic() - self.leader_seen > self.max_staleness:
+                    raise Exception(f"not heard from leader in {self.max_staleness} seconds")
+                return
+            if self.leader_id is None:
+                raise Exception("leader is unknown")
+            leader_id, requested_at = self.leader_id, time.monotonic()
+        read_index = self.leader_read_index(leader_id, requested_at)
+        with self.lock:
+            if not self.commit_cond.wait_for(lambda: self.last_applied >= read_index, self.commit_timeout):
+                raise Exception(f"timed out waiting for apply of log {read_index}")
+
+    def leader_read_index(self, leader_id, requested_at):
+        """
+        Ask the leader for readIndex, a read requested before an RPC was sent shares its result
+        :param requested_at: time.monotonic() the read was requested
+        """
+        with self.read_index_lock:
+            sent_at, read_index = self.last_read_index
+            if sent_at > requested_at:
+                return read_index  # commit_index confirmed after the read was requested
+            sent_at = time.monotonic()
+            try:
+                read_index = (self.bulk_proxies or self.proxies)[leader_id].readIndex()
+            except Exception as e:
+                raise Exception(f"readIndex of leader {leader_id} failed: {e}")
+            self.last_read_index = sent_at, read_index
+            return read_index
+
+    def getfileinfomap(self):
+        self.wait_readable()
+        with self.file_info_lock:
+            return self.surfstore.getfileinfomap()
+
+    def getfileinfomap_since(self, cursor):
+        self.wait_readable()
+        with self.file_info_lock:
+            return self.surfstore.getfileinfomap_since(cursor)
 
     def updatefile(self, filename, version, blocklist):
-        if self.isLeader():
+        with self.lock:
+            if not self.isLeader():
+                raise self.not_leader()
+            term = self.current_term
+            self.logs.append((term, (filename, version, blocklist)))  # store params only
+            pending_index = self.last_log_index()
+            self.apply_results[pending_index] = None
+            if self.wal is not None:
+                self.append_to_wal(pending_index, [self.logs[-1]])
+        try:
+            self.sync()  # persist before counting leader's own log, concurrent requests share the fsync
             with self.lock:
-                self.logs.append((self.current_term, (filename, version, blocklist)))  # store params only
-            pending_index = len(self.logs)
-            while self.isLeader() and self.commit_index < pending_index:
-                pass
-            if self.isLeader():
-                self.last_applied = pending_index
-                with self.file_info_lock:
-                    return self.surfstore.updatefile(filename, version, blocklist)
-        raise Exception("isCrashed or is not Leader")
+                if self.isLeader() and self.current_term == term:
+                    self.state.notify()
+                # also wake up if leadership lost, the entry may never commit
+                if not self.commit_cond.wait_for(
+                        lambda: self.last_applied >= pending_index or not self.isLeader() or self.current_term != term,
+                        self.commit_timeout):
+                    raise Exception(f"timed out waiting for commit of log {pending_index}")
+                if self.apply_results[pending_index] is not None and self.apply_results[pending_index][0] == term:
+                    return self.apply_results[pending_index][1]
+                raise Exception(f"lost leadership while waiting for commit of log {pending_index}")
+        finally:
+            with self.lock:
+                del self.apply_results[pending_index]
 
     def tester_getversion(self, filename):
         with self.file_info_lock:
@@ -226,21 +787,69 @@ def readconfig(config):
     return server_list, maxnum
 
 
+def ring_of(server_list, replication_factor):
+    """HashRing of servers in config, None if replication_factor is None"""
+    if replication_factor is None:
+        return None
+    return HashRing([f'{host}:{port}' for host, port in server_list], replication_factor)
+
+
 def main():
     parser = argparse.ArgumentParser(description="SurfStore server")
     parser.add_argument('config', help='path to config file')
     parser.add_argument('server_num', type=int, help='server number')
+    parser.add_argument('--wal-dir', default=None,
+                        help='directory of the write-ahead log, Raft state is kept in memory only by default')
+    parser.add_argument('--commit-timeout', type=float, default=None,
+                        help='seconds a client request waits for commit, wait forever by default')
+    parser.add_argument('--block-dir', default=None,
+                        help='directory of the on-disk block store, blocks are kept in memory by default')
+    parser.add_argument('--compression', choices=available(), default=None,
+                        help='compress blocks at rest, should be the same every time block dir is used')
+    parser.add_argument('--transport', choices=TRANSPORTS, default='xmlrpc',
+                        help='RPC protocol for clients and other servers, should be the same on all servers')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='serve binary transport on an asyncio event loop instead of one thread per connection')
+    parser.add_argument('--read-mode', choices=READ_MODES, default='readindex',
+                        help='confirm leadership for reads by a round of heartbeats, or by a lease relying on '
+                             'bounded clock drift, should be the same on all servers')
+    parser.add_argument('--replication-factor', type=int, default=None,
+                        help='shard blocks by consistent hashing of servers in config, each on this many servers, '
+                             'should be the same on all servers and clients, blocks are on all servers by default')
+    parser.add_argument('--follower-reads', choices=FOLLOWER_READS, default='off',
+                        help='let followers serve reads of fileinfomap, after confirming the commit index with the '
+                             'leader, or from local state no older than --max-staleness')
+    parser.add_argument('--max-staleness', type=float, default=MAX_STALENESS,
+                        help='seconds since a follower heard from the leader to serve stale reads')
     args = parser.parse_args()
+    if args.asyncio and args.transport != 'binary':
+        parser.error('--asyncio requires --transport binary')
+    if args.replication_factor is not None and args.replication_factor < 1:
+        parser.error('--replication-factor must be at least 1')
     config = args.config
     server_num = args.server_num
     server_list, _ = readconfig(config)
 
-    print("Attempting to start XML-RPC Server...")
-    with ThreadedXMLRPCServer(server_list[server_num],
-                              requestHandler=RequestHandler, use_builtin_types=True, logRequests=False) as server:
+    if args.asyncio:
+        print("Attempting to start asyncio binary RPC Server...")
+        server = AsyncRPCServer(server_list[server_num])
+    elif args.transport == 'binary':
+        print("Attempting to start binary RPC Server...")
+        server = BinaryRPCServer(server_list[server_num])
+    else:
+        print("Attempting to start XML-RPC Server...")
+        server = ThreadedXMLRPCServer(server_list[server_num],
+                                      requestHandler=RequestHandler, use_builtin_types=True, logRequests=False)
         server.register_introspection_functions()
-        surfstore = SurfstoreServer(SurfstoreServer.set_up_connections(server_list, server_num), server_num,
-                                    len(server_list))
+    with server:
+        peer_timeout = PEER_TIMEOUT if args.wal_dir is None else WAL_PEER_TIMEOUT
+        surfstore = SurfstoreServer(SurfstoreServer.set_up_connections(server_list, server_num, args.transport,
+                                                                       peer_timeout),
+                                    server_num, len(server_list), args.commit_timeout, args.wal_dir,
+                                    args.block_dir, args.compression, args.read_mode, args.follower_reads,
+                                    args.max_staleness, ring_of(server_list, args.replication_factor))
+        surfstore.bulk_proxies = SurfstoreServer.set_up_connections(server_list, server_num, args.transport,
+                                                                    BULK_TIMEOUT)
         server.register_instance(surfstore)
         surfstore.restore()
 
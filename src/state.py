@@ -1,10 +1,20 @@
 import random
+import time
 from abc import ABC
-from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread, Event
 
 HEARTBEAT_TIMEOUT = 0.01
 ELECTION_TIMEOUT = 0.5, 1.0
+# group commit knobs, larger values trade latency for throughput
+MAX_BATCH_SIZE = 64  # max entries in one AppendEntries
+MAX_BATCH_BYTES = 1 << 20  # max estimated bytes of entries in one AppendEntries
+MAX_LINGER = 0.001  # seconds to wait for more client requests before sending a partial batch
+MAX_INFLIGHT = 4  # max un-acked AppendEntries per follower
+SNAPSHOT_CHUNK_SIZE = 256 << 10  # bytes of snapshot in one InstallSnapshot
+# a leader holds a lease for this long after a majority acknowledged an AppendEntries sent at the start
+# shorter than ELECTION_TIMEOUT[0] in which followers refuse to elect another leader, by a margin for clock drift
+LEASE_TIMEOUT = ELECTION_TIMEOUT[0] * 0.9
 
 
 class State(ABC):
@@ -59,6 +69,7 @@ class Follower(State):
 class Candidate(State):
     def __init__(self, server):
         super().__init__(server)
+        self.votes = 0  # votes of the current round of election, locked by self.server.lock
         Thread(target=self.elect_leader, daemon=True).start()
 
     @property
@@ -67,40 +78,50 @@ class Candidate(State):
 
     def elect_leader(self):
         while True:
-            # preempt response to AppendEntries and RequestVote
-            # no dead lock because we do not send RequestVote to self
-            # should work because if AppendEntries, RequestVote pending:
-            # 1. this round of election should fail
-            # 2. after this round of election, timer should be canceled
             with self.server.lock:
+                if self.stop_event.is_set():
+                    break
                 self.server.current_term += 1
                 print(f'{self.server.id} {self.server.current_term} {self} elect_leader()')
 
                 # vote for self
                 self.server.voted_for = self.server.id
-                votes = 1
-                latest_term = self.server.current_term
-                for server_id, proxy in self.server.proxies.items():
-                    try:
-                        term, vote_granted = proxy.requestVote(self.server.current_term, self.server.id,
-                                                               len(self.server.logs),
-                                                               self.server.logs[-1][0] if self.server.logs else 0)
-                    except OSError:
-                        continue
-                    latest_term = max(latest_term, term)
-                    votes += vote_granted
-
-                if votes >= self.majority:
+                self.votes = 1
+                if self.votes >= self.majority:
                     self.server.transit_state(Leader)
                     break
-                elif latest_term > self.server.current_term:
-                    self.server.current_term = latest_term
-                    self.server.voted_for = None
-                    self.server.transit_state(Follower)
-                    break
+                term = self.server.current_term
+                log_index = self.server.last_log_index()
+                log_term = self.server.log_term(log_index)
+                proxies = list(self.server.proxies.values())
+            self.server.sync()  # persist term and vote before sending RequestVote
+            # send RequestVote to all peers at once, replies are counted as they arrive
+            for proxy in proxies:
+                Thread(target=self.request_vote, args=(proxy, term, log_index, log_term), daemon=True).start()
             if self.stop_event.wait(self.timeout):
                 break
 
+    def request_vote(self, proxy, term, log_index, log_term):
+        """
+        Send RequestVote to one peer and count the vote
+        Replies of previous rounds or after the election is decided are dropped
+        """
+        try:
+            reply_term, vote_granted = proxy.requestVote(term, self.server.id, log_index, log_term)
+        except Exception:  # lost reply as in Leader.append_entries()
+            return
+        with self.server.lock:
+            if self.stop_event.is_set() or term != self.server.current_term:
+                return
+            if reply_term > self.server.current_term:
+                self.server.current_term = reply_term
+                self.server.voted_for = None
+                self.server.transit_state(Follower)
+            elif vote_granted:
+                self.votes += 1
+                if self.votes >= self.majority:
+                    self.server.transit_state(Leader)
+
     def __repr__(self):
         return "Candidate"
 
@@ -108,59 +129,249 @@ class Candidate(State):
 class Leader(State):
     def __init__(self, server):
         super().__init__(server)
-        self.next_indexes = {server_id: len(self.server.logs) + 1
-                             for server_id in server.proxies.keys() if server_id != server.id}
-        self.match_indexes = {server_id: 0 for server_id in server.proxies.keys() if server_id != server.id}
-        Thread(target=self.append_entry, daemon=True).start()
+        peers = [server_id for server_id in server.proxies.keys() if server_id != server.id]
+        # all per-peer dicts are locked by self.server.lock
+        self.next_indexes = {server_id: self.server.last_log_index() + 1 for server_id in peers}
+        self.match_indexes = {server_id: 0 for server_id in peers}
+        # until a follower accepts, probe with empty AppendEntries to find where its log matches
+        self.probing = {server_id: True for server_id in peers}
+        self.inflight = {server_id: [] for server_id in peers}  # [(first, last)] index ranges of un-acked RPCs
+        self.heartbeat_at = {server_id: 0 for server_id in peers}  # time.monotonic() to send a heartbeat
+        self.wakeups = {server_id: Event() for server_id in peers}
+        self.read_seq = 0  # incremented by reads waiting for a round of heartbeats to confirm leadership
+        self.acked_seqs = {server_id: 0 for server_id in peers}  # read_seq of the last acknowledged AppendEntries
+        self.acked_at = {server_id: 0 for server_id in peers}  # time.monotonic() it was sent
+        # long-lived senders of each follower, proxies keep a connection per thread so RPCs reuse connections
+        self.senders = {server_id: ThreadPoolExecutor(MAX_INFLIGHT, thread_name_prefix=f'sender-{server_id}')
+                        for server_id in peers}
+        for server_id in peers:
+            Thread(target=self.replicate, args=(server_id,), daemon=True).start()
 
     @property
     def timeout(self):
         return HEARTBEAT_TIMEOUT
 
-    def append_entry(self):
+    def stop(self):
+        super().stop()
+        for wakeup in self.wakeups.values():
+            wakeup.set()
+        for sender in self.senders.values():
+            sender.shutdown(wait=False)
+
+    def notify(self):
+        """
+        Wake up all replicators to send new entries without waiting for the next heartbeat
+        Assume calling thread acquired self.server.lock
+        """
+        for wakeup in self.wakeups.values():
+            wakeup.set()
+        self.update_commit_index()  # leader alone may be the majority
+
+    def replicate(self, server_id):
+        """
+        Replicator of one follower, send AppendEntries every heartbeat or when notified
+        Entries appended meanwhile are coalesced into one batch, up to MAX_INFLIGHT batches are pipelined
+        Only entries after the in-flight ranges are sent, the follower is probed without entries after rejection
+        Network I/O is done without holding self.server.lock so that followers do not block each other
+        """
+        wakeup = self.wakeups[server_id]
+        inflight = self.inflight[server_id]
         while True:
-            entries = {server_id: [] for server_id in self.next_indexes.keys()}
+            wakeup.clear()
+            with self.server.lock:
+                if self.stop_event.is_set():
+                    break
+                num_new = self.server.last_log_index() - self.next_indexes[server_id] + 1
+            if 0 < num_new < MAX_BATCH_SIZE and MAX_LINGER:
+                # linger for concurrent client requests to join this batch
+                self.stop_event.wait(MAX_LINGER)
             with self.server.lock:
-                for server_id, next_index in self.next_indexes.items():
-                    # if last log index >= next_index for a follower, call appendEntry RPC
-                    if len(self.server.logs) >= next_index:
-                        entries[server_id] = self.server.logs[next_index - 1:]
-                latest_term = self.server.current_term
-                num_up = 1  # count self
-                for server_id, proxy in self.server.proxies.items():
+                if self.stop_event.is_set():
+                    break
+                probing = self.probing[server_id]
+                while len(inflight) < (1 if probing else MAX_INFLIGHT):
+                    # if last log index >= next_index for a follower, send entries from next_index
                     prev_index = self.next_indexes[server_id] - 1
-                    prev_term = self.server.logs[prev_index - 1][0] if prev_index else 0
-                    try:
-                        term, successful = proxy.appendEntries(self.server.current_term, prev_index, prev_term,
-                                                               entries[server_id], self.server.commit_index)
-                    except OSError:
-                        continue
-                    latest_term = max(latest_term, term)
-                    # update indexes if succeed, else decrement next_index then retry
-                    if successful:
-                        self.next_indexes[server_id] = len(self.server.logs) + 1
-                        self.match_indexes[server_id] = len(self.server.logs)
-                        num_up += 1
-                    elif term != -1:
-                        self.next_indexes[server_id] -= 1
-                        num_up += 1
-                self.server.num_up = num_up
-                # update commit_index if a log is replicated on majority of servers and is in self.currentTerm
-                for follower_commit in range(max(self.match_indexes.values()), self.server.commit_index, -1):
-                    num = reduce(lambda n, match_index: n + (follower_commit <= match_index),
-                                 self.match_indexes.values(), 0)
-                    # leader already append entry, num >= self.majority - 1 is enough
-                    if num >= self.majority - 1 and self.server.logs[follower_commit - 1][
-                        0] == self.server.current_term:
-                        self.server.commit_index = follower_commit
+                    if prev_index < self.server.snapshot_index:
+                        # logs needed by the follower are compacted, send snapshot instead
+                        # resent after a failure no sooner than a heartbeat, as probes are
+                        if not inflight and time.monotonic() >= self.heartbeat_at[server_id]:
+                            self.heartbeat_at[server_id] = time.monotonic() + self.timeout
+                            self.send_snapshot(server_id)
+                        break
+                    entries = [] if probing else self.batch(prev_index + 1)
+                    # in-flight AppendEntries serve as heartbeat
+                    if not entries and (inflight or time.monotonic() < self.heartbeat_at[server_id]):
                         break
+                    self.heartbeat_at[server_id] = time.monotonic() + self.timeout
+                    self.send(server_id, prev_index, entries)
+            wakeup.wait(self.timeout)
 
-                if latest_term > self.server.current_term:
-                    self.server.current_term = latest_term
-                    self.server.transit_state(Follower)
+    def batch(self, start):
+        """
+        Entries from index start, bounded by MAX_BATCH_SIZE and MAX_BATCH_BYTES
+        Assume calling thread acquired self.server.lock
+        """
+        entries = self.server.log_entries(start, start + MAX_BATCH_SIZE)
+        size = 0
+        for i, (_, cmd) in enumerate(entries):
+            # estimated by hashes and file name, at least one entry is sent
+            size += 16 + (len(cmd[0]) + 32 * len(cmd[2]) if cmd else 0)
+            if size > MAX_BATCH_BYTES and i:
+                return entries[:i]
+        return entries
+
+    def send(self, server_id, prev_index, entries):
+        """
+        Send AppendEntries by a sender of the follower, next_index is advanced optimistically to pipeline the next batch
+        Assume calling thread acquired self.server.lock
+        """
+        prev_term = self.server.log_term(prev_index)
+        self.next_indexes[server_id] = prev_index + len(entries) + 1
+        self.inflight[server_id].append((prev_index + 1, prev_index + len(entries)))
+        self.senders[server_id].submit(self.append_entries, server_id, self.server.current_term, prev_index,
+                                       prev_term, entries, self.server.commit_index, self.read_seq, time.monotonic())
+
+    def append_entries(self, server_id, term, prev_index, prev_term, entries, leader_commit, read_seq, sent_at):
+        try:
+            reply_term, successful, conflict_index, conflict_term = self.server.proxies[server_id].appendEntries(
+                term, prev_index, prev_term, entries, leader_commit, self.server.id)
+        except Exception:  # connection error, or remote error such as RPCError or Fault, as a lost reply
+            reply_term, successful, conflict_index, conflict_term = -1, False, 0, 0
+        with self.server.lock:
+            self.inflight[server_id].remove((prev_index + 1, prev_index + len(entries)))
+            self.wakeups[server_id].set()
+            if not self.stop_event.is_set():
+                if reply_term == term:
+                    # the follower accepts this leader, even if its log does not match yet
+                    self.acked_seqs[server_id] = max(self.acked_seqs[server_id], read_seq)
+                    self.acked_at[server_id] = max(self.acked_at[server_id], sent_at)
+                    self.server.commit_cond.notify_all()
+                self.on_reply(server_id, prev_index, len(entries), reply_term, successful,
+                              conflict_index, conflict_term)
+
+    def send_snapshot(self, server_id):
+        """
+        Send the current snapshot by a sender of the follower
+        Assume calling thread acquired self.server.lock
+        """
+        self.next_indexes[server_id] = self.server.snapshot_index + 1
+        self.inflight[server_id].append((1, self.server.snapshot_index))
+        self.senders[server_id].submit(self.install_snapshot, server_id, self.server.current_term,
+                                       self.server.snapshot_index, self.server.snapshot_term, self.server.snapshot)
+
+    def install_snapshot(self, server_id, term, last_index, last_term, data):
+        """
+        Stream snapshot to a follower in chunks of SNAPSHOT_CHUNK_SIZE
+        """
+        try:
+            for offset in range(0, len(data), SNAPSHOT_CHUNK_SIZE):
+                chunk = data[offset:offset + SNAPSHOT_CHUNK_SIZE]
+                reply_term, successful = self.server.proxies[server_id].installSnapshot(
+                    term, last_index, last_term, offset, chunk, offset + SNAPSHOT_CHUNK_SIZE >= len(data))
+                if not successful or self.stop_event.is_set():
                     break
-            if self.stop_event.wait(self.timeout):
+        except Exception:  # lost reply as in append_entries()
+            reply_term, successful = -1, False
+        with self.server.lock:
+            self.inflight[server_id].remove((1, last_index))
+            self.wakeups[server_id].set()
+            if not self.stop_event.is_set():
+                # on failure, rewind next_index before the snapshot so it is sent again
+                self.on_reply(server_id, last_index if successful else last_index - 1, 0, reply_term, successful)
+
+    def on_reply(self, server_id, prev_index, num_entries, reply_term, successful, conflict_index=0, conflict_term=0):
+        """
+        Handle the reply of AppendEntries from one follower
+        On rejection, conflict_index and conflict_term are hints from the follower to skip a whole term at once
+        Assume calling thread acquired self.server.lock
+        """
+        if reply_term > self.server.current_term:
+            self.server.current_term = reply_term
+            self.server.voted_for = None
+            self.server.transit_state(Follower)
+            return
+        # update indexes if succeed, else move next_index back then retry
+        if successful:
+            self.probing[server_id] = False
+            self.match_indexes[server_id] = max(self.match_indexes[server_id], prev_index + num_entries)
+            self.next_indexes[server_id] = max(self.next_indexes[server_id], prev_index + num_entries + 1)
+            self.update_commit_index()
+            return
+        self.probing[server_id] = True
+        if reply_term != -1:
+            self.heartbeat_at[server_id] = 0  # probe again right away
+            next_index = prev_index
+            if conflict_index:
+                # follower lacks logs after conflict_index, or its conflict_term starts at conflict_index
+                next_index = conflict_index
+                if conflict_term:
+                    # if leader has conflict_term, follower's logs of that term up to leader's last one match
+                    last_index = self.last_index_of_term(conflict_term, prev_index)
+                    if last_index:
+                        next_index = last_index + 1
+            self.next_indexes[server_id] = max(1, min(self.next_indexes[server_id], next_index, prev_index))
+        else:
+            # lost or follower unavailable, resend from this batch
+            self.next_indexes[server_id] = min(self.next_indexes[server_id], prev_index + 1)
+
+    def last_index_of_term(self, term, before):
+        """
+        Index of the last log with term before index before, 0 if not found in logs after snapshot
+        Assume calling thread acquired self.server.lock
+        """
+        for index in range(min(before, self.server.last_log_index()), self.server.snapshot_index, -1):
+            log_term = self.server.log_term(index)
+            if log_term == term:
+                return index
+            if log_term < term:
                 break
+        return 0
+
+    def confirm_leadership(self):
+        """
+        Send a round of heartbeats right away for ReadIndex
+        Assume calling thread acquired self.server.lock
+        :return: read_seq to check with confirmed()
+        """
+        self.read_seq += 1
+        for server_id in self.heartbeat_at:
+            self.heartbeat_at[server_id] = 0
+            self.wakeups[server_id].set()
+        return self.read_seq
+
+    def confirmed(self, read_seq):
+        """
+        Whether a majority acknowledged AppendEntries sent after confirm_leadership() returned read_seq
+        Assume calling thread acquired self.server.lock
+        """
+        return 1 + sum(acked >= read_seq for acked in self.acked_seqs.values()) >= self.majority
+
+    def lease_valid(self):
+        """
+        Whether no other leader can be elected yet, i.e. a majority acknowledged AppendEntries sent
+        within LEASE_TIMEOUT, followers refuse to vote for ELECTION_TIMEOUT[0] after that
+        Assume calling thread acquired self.server.lock
+        """
+        if self.majority == 1:
+            return True
+        acked_at = sorted(self.acked_at.values(), reverse=True)
+        return time.monotonic() < acked_at[self.majority - 2] + LEASE_TIMEOUT
+
+    def update_commit_index(self):
+        """
+        Update commit_index if a log is replicated on majority of servers and is in self.currentTerm
+        Assume calling thread acquired self.server.lock
+        """
+        # leader already append entry, so count its own log as matched once it is durable
+        match_indexes = sorted([self.server.durable_index(), *self.match_indexes.values()], reverse=True)
+        if len(match_indexes) < self.majority:
+            return
+        follower_commit = match_indexes[self.majority - 1]
+        if follower_commit > self.server.commit_index and \
+                self.server.log_term(follower_commit) == self.server.current_term:
+            self.server.commit_index = follower_commit
+            self.server.apply_committed()
 
     def __repr__(self):
         return "Leader"
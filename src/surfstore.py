@@ -1,17 +1,33 @@
+from collections import OrderedDict
 from hashlib import sha256
 
+from compression import RAW, available, compress, decompress, tag_of
+
+MAX_BATCH_BYTES = 4 << 20  # max total size of blocks returned by one getblocks()
+
 
 class SurfStore:
-    def __init__(self):
-        self.blocks = {}  # {hash: block}
+    def __init__(self, blocks=None, compression=None):
+        """
+        :param blocks: block store backend, any mapping {hash: block} e.g. blockstore.DiskBlockStore,
+                       an in-memory dict by default
+        :param compression: one of compression.available() to compress blocks at rest, blocks are raw by default
+                            the same blocks backend should always be used with or without compression
+        """
+        self.blocks = {} if blocks is None else blocks  # {hash: block}, block is compressed if compression is set
+        self.compression = compression
         self.file_infos = {}  # {file_name: [version, [blocks' hash]]}
+        # number of successful updatefile(), the same on servers applying the same logs
+        self.cursor = 0
+        self.changes = OrderedDict()  # {file_name: cursor after its last update} in update order
+        self.oldest_cursor = 0  # all updates after this cursor are in changes
 
     def getblock(self, h):
         """Gets a block, given a specific hash value"""
         print(f"GetBlock({h})")
         assert isinstance(h, bytes), "Hash must be bytes"
         assert h in self.blocks, "Can only get existing blocks"
-        return self.blocks[h]
+        return self.load(h)
 
     def putblock(self, b):
         """Puts a block"""
@@ -19,10 +35,80 @@ class SurfStore:
         assert isinstance(b, bytes), "Block must be bytes"
         assert len(b) > 0, "Block must be at least one byte large!"
         h = sha256(b).digest()
-        self.blocks[h] = b
+        self.store(h, b)
+        self.sync()
+        return True
+
+    def load(self, h, compression=None):
+        """
+        Block of hash h, compressed with compression if it is set
+        Blocks compressed at rest with the same compression are returned as is
+        """
+        block = self.blocks[h]
+        if self.compression is not None and self.compression == compression:
+            return block
+        if self.compression is not None:
+            block = decompress(block)
+        return block if compression is None else compress(block, compression)
+
+    def store(self, h, b, compressed=None):
+        """
+        Store block b of hash h
+        :param compressed: b compressed by compress(), stored as is if it can be
+        """
+        if self.compression is None:
+            self.blocks[h] = b
+        elif compressed is not None and compressed[0] in (RAW, tag_of(self.compression)):
+            self.blocks[h] = compressed
+        else:
+            self.blocks[h] = compress(b, self.compression)
+
+    def getcompressions(self):
+        """Compressions supported by getblocks() and putblocks()"""
+        return available()
 
+    def getblocks(self, hashes, compression=None):
+        """
+        Gets blocks in order, given their hash values
+        Only a prefix of at least one block and at most MAX_BATCH_BYTES in total is returned,
+        call again with the remaining hashes
+        :param compression: one of getcompressions() to get blocks compressed by compress()
+        """
+        print(f"GetBlocks({len(hashes)})")
+        assert all(isinstance(h, bytes) for h in hashes), "Hash must be bytes"
+        assert all(h in self.blocks for h in hashes), "Can only get existing blocks"
+        blocks, size = [], 0
+        for h in hashes:
+            block = self.load(h, compression)
+            if blocks and size + len(block) > MAX_BATCH_BYTES:
+                break
+            blocks.append(block)
+            size += len(block)
+        return blocks
+
+    def putblocks(self, blocks, compressed=False):
+        """
+        Puts blocks
+        :param compressed: whether blocks are compressed by compress(), hash is of the original block
+        """
+        print(f"PutBlocks({len(blocks)})")
+        assert all(isinstance(b, bytes) and len(b) > 0 for b in blocks), "Block must be at least one byte large!"
+        for b in blocks:
+            if compressed:
+                original = decompress(b)
+                assert len(original) > 0, "Block must be at least one byte large!"
+                self.store(sha256(original).digest(), original, b)
+            else:
+                self.store(sha256(b).digest(), b)
+        self.sync()  # durable before acknowledged, files referring to them commit afterwards
         return True
 
+    def sync(self):
+        """Make stored blocks durable if the blocks backend can, e.g. DiskBlockStore.sync(), one fsync a batch"""
+        sync = getattr(self.blocks, 'sync', None)
+        if sync is not None:
+            sync()
+
     def hasblocks(self, blocklist):
         """Get blocks on this server with hashes in input"""
         print("HasBlocks()")
@@ -34,6 +120,32 @@ class SurfStore:
         print("GetFileInfoMap()")
         return self.file_infos
 
+    def getfileinfomap_since(self, cursor):
+        """
+        Gets fileinfo entries updated after cursor returned by a previous call, 0 to get all entries
+        :return: [new cursor, whether entries are the whole map, {file_name: [version, [blocks' hash]]}]
+        """
+        print(f"GetFileInfoMapSince({cursor})")
+        if cursor == 0 or cursor < self.oldest_cursor or cursor > self.cursor:
+            # first call, changes are compacted, or cursor is from another server
+            return [self.cursor, True, self.file_infos]
+        changed = {}
+        for file_name in reversed(self.changes):
+            if self.changes[file_name] <= cursor:
+                break
+            changed[file_name] = self.file_infos[file_name]
+        return [self.cursor, False, changed]
+
+    def snapshot(self):
+        """State to be restored by restore(), a copy that can be serialized while files are updated"""
+        return [dict(self.file_infos), self.cursor]
+
+    def restore(self, state):
+        """Replace file infos by snapshot(), changes before the snapshot are lost"""
+        self.file_infos, self.cursor = state
+        self.changes = OrderedDict()
+        self.oldest_cursor = self.cursor
+
     def updatefile(self, filename, version, blocklist):
         """Updates a file's fileinfo entry"""
         assert isinstance(version, int), "Version must be int"
@@ -43,4 +155,7 @@ class SurfStore:
             return False
         assert not (filename not in self.file_infos and version != 1), "Version of file creation must be one"
         self.file_infos[filename] = [version, blocklist]
+        self.cursor += 1
+        self.changes[filename] = self.cursor
+        self.changes.move_to_end(filename)
         return True
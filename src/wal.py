@@ -0,0 +1,250 @@
+import os
+import struct
+import zlib
+from threading import Lock
+
+import codec
+
+# record types
+ENTRIES, HARD_STATE, COMMIT = range(3)
+
+HEADER = struct.Struct('>IIB')  # payload length, crc32 of type and payload, type
+SNAPSHOT_HEADER = struct.Struct('>II')  # payload length, crc32 of payload
+SEGMENT_SIZE = 16 << 20  # start a new segment file when the current one exceeds this size
+SEGMENT_SUFFIX = '.wal'
+SNAPSHOT_NAME = 'snapshot'
+
+
+class WriteAheadLog:
+    """
+    Append-only write-ahead log of Raft state, stored in segment files under directory
+    Each record is [length, crc32, type, payload], payload is serialized by codec
+    Records are buffered by append_*() and made durable by sync(), concurrent syncs share one fsync
+    Log prefix covered by the latest snapshot is compacted by save_snapshot(), or write_snapshot() then compact()
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = Lock()  # protects file and written
+        self.sync_lock = Lock()  # serializes fsync, protects synced
+        self.written = 0  # number of records written
+        self.synced = 0  # number of records durable on disk
+        self.snapshot_lock = Lock()  # serializes snapshot writes, protects snapshot_index
+        self.snapshot_index = 0  # log index covered by the snapshot on disk
+        self.file = None
+        os.makedirs(directory, exist_ok=True)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+
+    def recover(self):
+        """
+        Load the snapshot, replay all segments and open the last one for appending
+        A torn record at the tail of the last segment is truncated, corruption elsewhere raises an Exception
+        :return: current_term, voted_for, (snapshot index, snapshot term, snapshot data) or None,
+                 logs [(term, cmd)] after the snapshot, commit_index
+        """
+        snapshot = self.load_snapshot()
+        snapshot_index = self.snapshot_index = snapshot[0] if snapshot else 0
+        current_term, voted_for, logs, commit_index = 0, None, [], 0
+        segments = self.segments()
+        for i, name in enumerate(segments):
+            path = os.path.join(self.directory, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            offset = 0
+            while offset < len(data):
+                record = self.read_record(data, offset)
+                if record is None:
+                    if i != len(segments) - 1:
+                        raise Exception(f"corrupted record in {path} at {offset}")
+                    print(f"WriteAheadLog: truncate torn record in {path} at {offset}")
+                    with open(path, 'r+b') as f:
+                        f.truncate(offset)
+                    break
+                offset, rtype, payload = record
+                if rtype == ENTRIES:
+                    index, entries = payload
+                    if index <= snapshot_index:
+                        # left by a crash during compaction, drop entries covered by the snapshot
+                        entries = entries[snapshot_index - index + 1:]
+                        index = snapshot_index + 1
+                    del logs[index - snapshot_index - 1:]
+                    logs.extend((term, tuple(cmd) if cmd is not None else None) for term, cmd in entries)
+                elif rtype == HARD_STATE:
+                    current_term, voted_for = payload
+                elif rtype == COMMIT:
+                    commit_index = payload
+        self.open_segment(segments[-1] if segments else None)
+        # commit records are not synced, while logs in the snapshot are committed
+        return current_term, voted_for, snapshot, logs, max(min(commit_index, snapshot_index + len(logs)),
+                                                            snapshot_index)
+
+    def load_snapshot(self):
+        """
+        :return: (snapshot index, snapshot term, snapshot data) or None if there is no snapshot
+        """
+        path = os.path.join(self.directory, SNAPSHOT_NAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        length, crc = SNAPSHOT_HEADER.unpack_from(data)
+        body = data[SNAPSHOT_HEADER.size:]
+        if len(body) != length or zlib.crc32(body) != crc:
+            raise Exception(f"corrupted snapshot {path}")
+        return tuple(codec.loads(body))
+
+    def save_snapshot(self, index, term, data, current_term, voted_for, logs, commit_index):
+        """
+        Persist a snapshot covering logs up to index, then compact the log
+        """
+        self.write_snapshot(index, term, data)
+        self.compact(index, current_term, voted_for, logs, commit_index)
+
+    def write_snapshot(self, index, term, data):
+        """
+        Persist a snapshot covering logs up to index, records are kept until compact()
+        Appends may go on meanwhile, a snapshot not newer than the one on disk is dropped
+        :return: whether the snapshot is written
+        """
+        body = codec.dumps([index, term, data])
+        path = os.path.join(self.directory, SNAPSHOT_NAME)
+        with self.snapshot_lock:
+            if index <= self.snapshot_index:
+                return False
+            with open(path + '.tmp', 'wb') as f:
+                f.write(SNAPSHOT_HEADER.pack(len(body), zlib.crc32(body)) + body)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)  # atomic, the previous snapshot is valid until replaced
+            self.fsync_directory()
+            self.snapshot_index = index
+        return True
+
+    def compact(self, index, current_term, voted_for, logs, commit_index):
+        """
+        Drop records covered by the snapshot at index, which should be written by write_snapshot() already
+        Records still needed, i.e. hard state, logs after index and commit_index, are rewritten
+        to a new segment and all previous segments are deleted
+        """
+        with self.sync_lock, self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            old_segments = self.segments()
+            self.open_segment()
+            self.write(self.encode(HARD_STATE, [current_term, voted_for]))
+            if logs:
+                self.write(self.encode(ENTRIES, [index + 1, logs]))
+            self.write(self.encode(COMMIT, commit_index))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.synced = self.written
+            for name in old_segments:
+                os.remove(os.path.join(self.directory, name))
+            self.fsync_directory()
+
+    def fsync_directory(self):
+        """Make file creation, rename and deletion in directory durable"""
+        if hasattr(os, 'O_DIRECTORY'):  # not supported on Windows
+            fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def read_record(data, offset):
+        """
+        Parse the record at offset
+        :return: (next offset, type, payload), or None if the record is incomplete or fails CRC check
+        """
+        if offset + HEADER.size > len(data):
+            return None
+        length, crc, rtype = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        body = data[start:start + length]
+        if len(body) != length or zlib.crc32(body, zlib.crc32(bytes([rtype]))) != crc:
+            return None
+        return start + length, rtype, codec.loads(body)
+
+    def open_segment(self, name=None):
+        """
+        Open segment name for appending, or a new segment after the last one
+        Assume calling thread acquired self.lock or no other thread uses the log yet
+        """
+        if name is None:
+            segments = self.segments()
+            seq = int(segments[-1][:-len(SEGMENT_SUFFIX)]) + 1 if segments else 0
+            name = f'{seq:08d}{SEGMENT_SUFFIX}'
+        self.file = open(os.path.join(self.directory, name), 'ab')
+
+    @staticmethod
+    def encode(rtype, payload):
+        body = codec.dumps(payload)
+        return HEADER.pack(len(body), zlib.crc32(body, zlib.crc32(bytes([rtype]))), rtype) + body
+
+    def write(self, record):
+        """
+        Write an encoded record to the current segment, start a new segment if it is full
+        Assume calling thread acquired self.lock
+        """
+        if self.file.tell() >= self.segment_size:
+            # previous segments must be durable before the new one is written
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.open_segment()
+        self.file.write(record)
+        self.written += 1
+        return self.written
+
+    def append(self, rtype, payload):
+        """
+        Buffer a record, call sync() to make it durable
+        :return: sequence number of the record
+        """
+        record = self.encode(rtype, payload)
+        with self.lock:
+            return self.write(record)
+
+    def append_entries(self, index, entries):
+        """Log entries starting at log index, replacing existing entries from index"""
+        return self.append(ENTRIES, [index, entries])
+
+    def set_hard_state(self, current_term, voted_for):
+        return self.append(HARD_STATE, [current_term, voted_for])
+
+    def set_commit_index(self, commit_index):
+        return self.append(COMMIT, commit_index)
+
+    def sync(self, seq=None):
+        """
+        Make records up to seq (all written records by default) durable
+        Callers arriving during an fsync wait for it and are covered by the next one (group commit)
+        """
+        with self.sync_lock:
+            if seq is not None and self.synced >= seq:
+                return
+            with self.lock:
+                if self.synced >= self.written:
+                    return
+                target = self.written
+                self.file.flush()
+                # fsync a duplicate so appends can continue, and roll over, while we wait on the disk
+                fd = os.dup(self.file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.synced = target
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+from hashlib import sha256
+
+from src.blockstore import DiskBlockStore
+from src.surfstore import SurfStore
+
+
+class TestDiskBlockStore(unittest.TestCase):
+    """
+    Test on-disk block store without RPC
+    """
+
+    def setUp(self) -> None:
+        self.block_dir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.block_dir)
+
+    def test_surfstore(self):
+        with DiskBlockStore(self.block_dir) as blocks:
+            server = SurfStore(blocks)
+            b = os.urandom(4096)
+            h = sha256(b).digest()
+            server.putblock(b)
+            self.assertEqual(server.getblock(h), b)
+            self.assertEqual(server.hasblocks([h, sha256(b'lala').digest()]), [h])
+            # one fsync for each batch of put blocks
+            fsyncs = []
+            fsync, os.fsync = os.fsync, fsyncs.append
+            try:
+                server.putblocks([os.urandom(4096) for _ in range(10)])
+            finally:
+                os.fsync = fsync
+            self.assertEqual(len(fsyncs), 1)
+            self.assertEqual(blocks.synced, blocks.written)
+
+    def test_reopen(self):
+        blocks = {}
+        with DiskBlockStore(self.block_dir, segment_size=10000) as store:
+            for _ in range(10):
+                b = os.urandom(4096)
+                blocks[sha256(b).digest()] = b
+                store[sha256(b).digest()] = b
+            # put again is deduplicated
+            store[sha256(b).digest()] = b
+            self.assertGreater(len(store.segments()), 1)
+
+        with DiskBlockStore(self.block_dir, segment_size=10000) as store:
+            self.assertEqual(len(store), 10)
+            self.assertEqual({h: store[h] for h in store}, blocks)
+            with self.assertRaises(KeyError):
+                store[sha256(b'lala').digest()]
+
+    def test_no_mmap(self):
+        with DiskBlockStore(self.block_dir, segment_size=1, use_mmap=False) as store:
+            b = os.urandom(100)
+            store[sha256(b).digest()] = b
+            store[sha256(b'lala').digest()] = b'lala'
+            self.assertEqual(store[sha256(b).digest()], b)
+            self.assertFalse(store.maps)
+
+    def test_cache(self):
+        with DiskBlockStore(self.block_dir, cache_size=10000) as store:
+            hs = []
+            for _ in range(5):
+                b = os.urandom(4096)
+                hs.append(sha256(b).digest())
+                store[hs[-1]] = b
+            for h in hs:
+                store[h]
+            # only the two most recent blocks fit
+            self.assertEqual(list(store.cache), hs[-2:])
+            self.assertLessEqual(store.cached_bytes, 10000)
+
+    def test_torn_tail(self):
+        b = os.urandom(4096)
+        with DiskBlockStore(self.block_dir) as store:
+            store[sha256(b).digest()] = b
+            store[sha256(b'lala').digest()] = b'lala'
+            path = store.path(store.active)
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 1)
+
+        with DiskBlockStore(self.block_dir) as store:
+            self.assertEqual(list(store), [sha256(b).digest()])
+            # store is still appendable after truncating the torn record
+            store[sha256(b'lala').digest()] = b'lala'
+        with DiskBlockStore(self.block_dir) as store:
+            self.assertEqual(store[sha256(b'lala').digest()], b'lala')
+
+
+if __name__ == '__main__':
+    unittest.main()
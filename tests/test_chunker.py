@@ -0,0 +1,66 @@
+import io
+import os
+import unittest
+
+from src.chunker import CDCChunker, FixedChunker
+
+
+class TestChunker(unittest.TestCase):
+    """
+    Test splitting files into blocks
+    """
+
+    def test_fixed(self):
+        data = os.urandom(10000)
+        self.assertEqual(list(FixedChunker(4096).chunks(io.BytesIO(data))),
+                         [data[:4096], data[4096:8192], data[8192:]])
+
+    def test_cdc_sizes(self):
+        chunker = CDCChunker(256, 1024, 4096)
+        data = os.urandom(1 << 18)
+        blocks = list(chunker.chunks(io.BytesIO(data)))
+        self.assertEqual(b''.join(blocks), data)
+        for block in blocks[:-1]:
+            self.assertGreaterEqual(len(block), 256)
+            self.assertLessEqual(len(block), 4096)
+        # average is close to avg_size
+        self.assertLess(abs(len(data) / len(blocks) - 1024), 512)
+        # long runs without cut points are cut at max_size
+        self.assertEqual([len(b) for b in chunker.chunks(io.BytesIO(bytes(10000)))], [4096, 4096, 1808])
+
+    def test_cdc_insert(self):
+        """Only blocks from the one containing an insertion until cut points meet again change"""
+        chunker = CDCChunker(256, 1024, 4096)
+        changed = []
+        for _ in range(100):
+            data = os.urandom(1 << 14)
+            blocks = list(chunker.chunks(io.BytesIO(data)))
+            middle = len(data) // 2
+            new_blocks = list(chunker.chunks(io.BytesIO(data[:middle] + b'lala' + data[middle:])))
+            prefix = 0
+            while blocks[prefix] == new_blocks[prefix]:
+                prefix += 1
+            suffix = 0
+            while suffix < min(len(blocks), len(new_blocks)) - prefix and \
+                    blocks[-1 - suffix] == new_blocks[-1 - suffix]:
+                suffix += 1
+            # blocks before the one containing the insertion are kept
+            self.assertTrue(middle - 4096 < sum(len(b) for b in blocks[:prefix]) <= middle)
+            changed.append(len(new_blocks) - prefix - suffix)
+        # how long cut points take to meet again depends on content, usually the next one
+        self.assertLessEqual(sum(changed) / len(changed), 2)
+
+    def test_cdc_small_reads(self):
+        """Cut points do not depend on how the file is read"""
+        data = os.urandom(1 << 16)
+        chunker = CDCChunker(64, 256, 1024)
+
+        class SmallReads(io.BytesIO):
+            def read(self, size=-1):
+                return super().read(min(size, 1000))
+
+        self.assertEqual(list(chunker.chunks(SmallReads(data))), list(chunker.chunks(io.BytesIO(data))))
+
+
+if __name__ == '__main__':
+    unittest.main()
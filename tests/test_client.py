@@ -1,11 +1,17 @@
 import os
 import shutil
 import tempfile
+import threading
+import time
 import unittest
 from hashlib import sha256
+from unittest import mock
 
-from src.client import SurfstoreClient
-from src.server import SurfstoreServer
+from src.chunker import CDCChunker
+from src.client import ClusterProxy, SurfstoreClient
+from src.ring import HashRing
+from src.rpc import RPCError
+from src.surfstore import SurfStore
 
 
 def versioned_files_to_index(files, block_size):
@@ -21,7 +27,7 @@ def versioned_files_to_index(files, block_size):
 
 
 def versioned_files_to_server(files, block_size):
-    server = SurfstoreServer()
+    server = SurfStore()
     for name, (ver, bs) in files.items():
         server.file_infos[name] = [ver, []]
         for i in range(0, len(bs), block_size):
@@ -99,11 +105,138 @@ class TestClientAlone(unittest.TestCase):
             for h in infomap[1]:
                 self.assertIs(type(h), bytes)
 
+    def test_hash_ranges(self):
+        data = os.urandom(10 * self.block_size + 1)
+        files_to_folder(self.base_dir, {'lala.bin': data})
+        # every two blocks are hashed by one task
+        with mock.patch('src.client.HASH_RANGE_SIZE', 2 * self.block_size):
+            client = SurfstoreClient(None, self.base_dir, self.block_size, hash_workers=3)
+            base_infos = client.scan_base()
+        self.assertEqual(base_infos['lala.bin'][1], [sha256(data[i:i + self.block_size]).digest()
+                                                     for i in range(0, len(data), self.block_size)])
+        self.assertEqual(client.file_blocks['lala.bin'],
+                         [(i, min(self.block_size, len(data) - i)) for i in range(0, len(data), self.block_size)])
+
+    def test_hash_cache(self):
+        hash_cache = os.path.join(self.base_dir, '.hash_cache')
+        files = {'lala.bin': os.urandom(10000), 'lala2.bin': os.urandom(10000)}
+        files_to_folder(self.base_dir, files)
+        old = time.time() - 10
+        for name in files:
+            os.utime(os.path.join(self.base_dir, name), (old, old))
+
+        client = SurfstoreClient(None, self.base_dir, self.block_size, hash_cache=hash_cache)
+        base_infos = client.scan_base()
+        self.assertNotIn('.hash_cache', base_infos)
+
+        client = SurfstoreClient(None, self.base_dir, self.block_size, hash_cache=hash_cache)
+        client.hash_ranges = None  # unchanged files are not hashed again
+        self.assertEqual(client.scan_base(), base_infos)
+        self.assertEqual(client.file_blocks['lala.bin'], [(0, 4096), (4096, 4096), (8192, 1808)])
+
+        # modified file is hashed again, recently modified file is not cached
+        files_to_folder(self.base_dir, {'lala.bin': os.urandom(10000)})
+        client = SurfstoreClient(None, self.base_dir, self.block_size, hash_cache=hash_cache)
+        new_infos = client.scan_base()
+        self.assertNotEqual(new_infos['lala.bin'], base_infos['lala.bin'])
+        self.assertEqual(new_infos['lala2.bin'], base_infos['lala2.bin'])
+        self.assertEqual(set(client.read_hash_cache()), {'lala2.bin'})
+
+    def test_readers(self):
+        files = {'lala.bin': [1, os.urandom(10000)], 'lala2.bin': [1, os.urandom(10000)]}
+        server = versioned_files_to_server(files, self.block_size)
+        # the replica has the map but misses blocks of lala2.bin
+        replica = versioned_files_to_server({'lala.bin': files['lala.bin']}, self.block_size)
+        replica.file_infos = server.file_infos
+        read = []
+
+        class Replica:
+            def __getattr__(self, name):
+                read.append(name)
+                return getattr(replica, name)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+        with SurfstoreClient(server, self.base_dir, self.block_size, readers=[Replica]) as client:
+            client.run()
+        self.assertEqual({n: bs for n, (_, bs) in files.items()}, folder_to_files(self.base_dir))
+        self.assertIn('getfileinfomap_since', read)
+        self.assertIn('getblocks', read)
+
     def tearDown(self) -> None:
         # remove tmp directory after test
         shutil.rmtree(self.base_dir)
 
 
+class TestClusterProxy(unittest.TestCase):
+    def test_redirect(self):
+        calls = []
+
+        class Server:
+            def __init__(self, server_id, error):
+                self.server_id = server_id
+                self.error = error
+
+            def getfileinfomap(self):
+                calls.append(self.server_id)
+                if self.error is not None:
+                    raise self.error
+                return {}
+
+            def __exit__(self, *args):
+                pass
+
+        proxy = ClusterProxy([Server(0, RPCError("<class 'Exception'>:isCrashed or is not Leader, leader is 2")),
+                              Server(1, ConnectionRefusedError()),
+                              Server(2, None)])
+        self.assertEqual(proxy.getfileinfomap(), {})
+        self.assertEqual(calls, [0, 2])
+        # the leader is cached
+        proxy.getfileinfomap()
+        self.assertEqual(calls, [0, 2, 2])
+        # unreachable servers are skipped
+        proxy.leader = 1
+        proxy.getfileinfomap()
+        self.assertEqual(calls, [0, 2, 2, 1, 2])
+        proxy.close()
+
+    def test_updatefile_reply_lost(self):
+        """A retried updatefile should succeed if the lost call committed the same version"""
+        h = os.urandom(32)
+
+        class Server:
+            def __init__(self, error):
+                self.error = error
+                self.file_infos = {}
+
+            def updatefile(self, filename, version, blocklist):
+                result = filename not in self.file_infos
+                if result:
+                    self.file_infos[filename] = [version, blocklist]
+                if self.error is not None:  # the reply is lost
+                    error, self.error = self.error, None
+                    raise error
+                return result
+
+            def getfileinfomap(self):
+                return self.file_infos
+
+            def __exit__(self, *args):
+                pass
+
+        proxy = ClusterProxy([Server(ConnectionResetError())])
+        self.assertTrue(proxy.updatefile('lala.bin', 1, [h]))
+        self.assertFalse(proxy.updatefile('lala.bin', 1, [h]))
+        # another client committed this version
+        proxy = ClusterProxy([Server(ConnectionResetError())])
+        proxy.proxies[0].file_infos['lala.bin'] = [1, [os.urandom(32)]]
+        self.assertFalse(proxy.updatefile('lala.bin', 1, [h]))
+
+
 class TestClientWithServer(unittest.TestCase):
     """
     Test client's functionality together with server.
@@ -252,6 +385,183 @@ class TestClientWithServer(unittest.TestCase):
         with open(self.index_txt) as f:
             self.assertEqual(versioned_files_to_index(new_files, self.block_size), f.read())
 
+    def test_modified_during_upload(self):
+        files = {'lala.bin': os.urandom(10000)}
+        server = versioned_files_to_server({}, self.block_size)
+        files_to_folder(self.base_dir, files)
+
+        client = SurfstoreClient(server, self.base_dir, self.block_size)
+        base_infos = client.scan_base()
+        # blocks are not kept in memory
+        self.assertEqual(client.file_blocks['lala.bin'], [(0, 4096), (4096, 4096), (8192, 1808)])
+        files_to_folder(self.base_dir, {'lala.bin': os.urandom(10000)})
+        base_infos['lala.bin'][0] = 1
+        with self.assertRaises(Exception):
+            client.upload('lala.bin', base_infos['lala.bin'])
+        self.assertEqual({}, server.file_infos)
+
+    def test_cdc_insert(self):
+        data = os.urandom(1 << 17)
+        files_to_folder(self.base_dir, {'lala.bin': data})
+        server = versioned_files_to_server({}, self.block_size)
+        chunker = CDCChunker(256, 1024, 4096)
+
+        SurfstoreClient(server, self.base_dir, 1024, chunker=chunker).run()
+        num_blocks = len(server.blocks)
+        files_to_folder(self.base_dir, {'lala.bin': b'lala' + data})
+        SurfstoreClient(server, self.base_dir, 1024, chunker=chunker).run()
+
+        # only the first block is uploaded again
+        self.assertLessEqual(len(server.blocks), num_blocks + 2)
+        self.assertEqual({'lala.bin': [2, b'lala' + data]}, server_to_versioned_files(server))
+        self.assertEqual(SurfstoreClient(None, self.base_dir, 1024, chunker=chunker).read_index(),
+                         server.file_infos)
+
+    def test_download_local_blocks(self):
+        index_files = {'lala.bin': [1, os.urandom(10 * self.block_size)]}
+        data = index_files['lala.bin'][1]
+        # server version changes the first block and copies blocks of the other local file
+        other = os.urandom(2 * self.block_size)
+        server_files = {'lala.bin': [2, os.urandom(self.block_size) + data[self.block_size:] + other]}
+        server = versioned_files_to_server(server_files, self.block_size)
+        fetched = []
+        getblocks = server.getblocks
+        server.getblocks = lambda hashes: fetched.extend(hashes) or getblocks(hashes)
+        with open(self.index_txt, 'w') as f:
+            f.write(versioned_files_to_index(index_files, self.block_size))
+        files_to_folder(self.base_dir, {'lala.bin': data, 'lala2.bin': other})
+
+        client = SurfstoreClient(server, self.base_dir, self.block_size)
+        client.run()
+
+        self.assertEqual(fetched, server.file_infos['lala.bin'][1][:1])
+        self.assertEqual(folder_to_files(self.base_dir), {'lala.bin': server_files['lala.bin'][1], 'lala2.bin': other})
+
+    def test_compression(self):
+        files = {'lala.bin': [1, b'lala ' * 10000]}
+        server = SurfStore(compression='zlib')
+        files_to_folder(self.base_dir, {'lala.bin': files['lala.bin'][1]})
+        putblocks = server.putblocks
+        sent = []
+        server.putblocks = lambda blocks, compressed=False: sent.extend(blocks) or putblocks(blocks, compressed)
+
+        SurfstoreClient(server, self.base_dir, self.block_size, compression='zlib').run()
+        self.assertLess(sum(len(b) for b in sent), len(files['lala.bin'][1]) // 10)
+
+        os.remove(os.path.join(self.base_dir, 'lala.bin'))
+        os.remove(self.index_txt)
+        SurfstoreClient(server, self.base_dir, self.block_size, compression='zlib').run()
+        self.assertEqual({'lala.bin': files['lala.bin'][1]}, folder_to_files(self.base_dir))
+
+    def test_map_cache(self):
+        map_cache = os.path.join(self.base_dir, '.map_cache')
+        files = {'lala.bin': [1, os.urandom(10000)], 'lala2.bin': [1, os.urandom(10000)]}
+        server = SurfStore()
+        files_to_folder(self.base_dir, {n: bs for n, (_, bs) in files.items()})
+        with SurfstoreClient(server, self.base_dir, self.block_size, map_cache=map_cache) as client:
+            client.run()
+            client.run()  # get entries of uploaded files
+
+        transferred = []
+        since = server.getfileinfomap_since
+        server.getfileinfomap_since = lambda cursor: transferred.append(since(cursor)) or transferred[-1]
+        server.updatefile('lala.bin', 2, [])
+        client = SurfstoreClient(server, self.base_dir, self.block_size, map_cache=map_cache)
+        client.run()
+        # only the changed entry is transferred
+        self.assertEqual([infos for _, _, infos in transferred], [{'lala.bin': [2, []]}])
+        self.assertEqual(client.get_fileinfomap(), server.getfileinfomap())
+        self.assertEqual(folder_to_files(self.base_dir).keys(), {'lala2.bin', '.map_cache'})
+
+    def test_ring(self):
+        files = {'lala.bin': [1, os.urandom(100000)]}
+        server = versioned_files_to_server({}, self.block_size)
+        ring = HashRing(['a', 'b', 'c'], 1)
+        block_servers = [SurfStore() for _ in range(3)]
+        files_to_folder(self.base_dir, {'lala.bin': files['lala.bin'][1]})
+        SurfstoreClient(server, self.base_dir, self.block_size, ring=ring, block_servers=block_servers).run()
+
+        hashes = server.file_infos['lala.bin'][1]
+        for h in hashes:
+            self.assertEqual([i for i, s in enumerate(block_servers) if h in s.blocks], ring.owners(h))
+        self.assertFalse(server.blocks)
+
+        new_dir = tempfile.mkdtemp()
+        try:
+            SurfstoreClient(server, new_dir, self.block_size, ring=ring, block_servers=block_servers).run()
+            self.assertEqual(folder_to_files(new_dir), {'lala.bin': files['lala.bin'][1]})
+        finally:
+            shutil.rmtree(new_dir)
+
+    def test_ring_owner_down(self):
+        """Blocks of an owner which is down should be put to and got from their next owners"""
+
+        class DownServer:
+            def __getattr__(self, name):
+                def call(*args):
+                    raise OSError("connection refused")
+
+                return call
+
+        files = {'lala.bin': [1, os.urandom(100000)]}
+        server = versioned_files_to_server({}, self.block_size)
+        ring = HashRing(['a', 'b', 'c'], 2)
+        block_servers = [SurfStore(), DownServer(), SurfStore()]
+        files_to_folder(self.base_dir, {'lala.bin': files['lala.bin'][1]})
+        SurfstoreClient(server, self.base_dir, self.block_size, ring=ring, block_servers=block_servers).run()
+
+        hashes = server.file_infos['lala.bin'][1]
+        self.assertTrue(any(ring.owners(h)[0] == 1 for h in hashes))
+        for h in hashes:
+            # put to the primary owner, or the next one if the primary is down
+            self.assertIn(h, block_servers[next(i for i in ring.owners(h) if i != 1)].blocks)
+        self.assertFalse(server.blocks)
+
+        new_dir = tempfile.mkdtemp()
+        try:
+            SurfstoreClient(server, new_dir, self.block_size, ring=ring, block_servers=block_servers).run()
+            self.assertEqual(folder_to_files(new_dir), {'lala.bin': files['lala.bin'][1]})
+        finally:
+            shutil.rmtree(new_dir)
+
+    def test_parallel_transfer(self):
+        block_size = 1 << 20
+        files = {'lala.bin': [1, os.urandom(10 * block_size + 1)]}
+        server = versioned_files_to_server(files, block_size)
+        connected = []
+
+        class SlowServer:
+            """Per-worker proxy, the first batch arrives last"""
+
+            def __init__(self):
+                connected.append(threading.current_thread())
+
+            def getblocks(self, hashes):
+                if hashes[0] == server.file_infos['lala.bin'][1][0]:
+                    time.sleep(0.1)
+                return server.getblocks(hashes)
+
+            def putblocks(self, blocks):
+                return server.putblocks(blocks)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+        with SurfstoreClient(server, self.base_dir, block_size, workers=3, connect=SlowServer) as client:
+            client.run()
+            self.assertEqual({'lala.bin': files['lala.bin'][1]}, folder_to_files(self.base_dir))
+
+            new_files = {'lala.bin': [2, os.urandom(10 * block_size)]}
+            files_to_folder(self.base_dir, {'lala.bin': new_files['lala.bin'][1]})
+            client.run()
+            self.assertEqual(new_files, server_to_versioned_files(server))
+        # one proxy for each worker
+        self.assertEqual(len(connected), len(set(connected)))
+        self.assertLessEqual(len(connected), 3)
+
     def tearDown(self) -> None:
         # remove tmp directory after test
         shutil.rmtree(self.base_dir)
@@ -0,0 +1,44 @@
+import os
+import unittest
+from hashlib import sha256
+
+from src.compression import RAW, available, compress, decompress
+from src.surfstore import SurfStore
+
+
+class TestCompression(unittest.TestCase):
+    """
+    Test block compression on the wire and at rest without RPC
+    """
+
+    def test_round_trip(self):
+        text = b'lala ' * 1000
+        for compression in available():
+            compressed = compress(text, compression)
+            self.assertLess(len(compressed), len(text))
+            self.assertEqual(decompress(compressed), text)
+            # incompressible block is kept raw
+            block = os.urandom(4096)
+            self.assertEqual(compress(block, compression), bytes([RAW]) + block)
+            self.assertEqual(compress(os.urandom(1 << 16) + text, compression)[0], RAW)
+
+    def test_surfstore(self):
+        text = b'lala ' * 1000
+        h = sha256(text).digest()
+        server = SurfStore(compression='zlib')
+        self.assertIn('zlib', server.getcompressions())
+        server.putblock(text)
+        # compressed at rest, hash is of the original block
+        self.assertLess(len(server.blocks[h]), len(text))
+        self.assertEqual(server.getblock(h), text)
+        self.assertEqual(server.getblocks([h]), [text])
+        self.assertEqual([decompress(b) for b in server.getblocks([h], 'zlib')], [text])
+
+        server = SurfStore()
+        self.assertTrue(server.putblocks([compress(text, 'zlib')], True))
+        self.assertEqual(server.blocks[h], text)
+        self.assertEqual(server.hasblocks([h]), [h])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import unittest
+from collections import Counter
+
+from src.ring import HashRing
+
+
+class TestHashRing(unittest.TestCase):
+    """
+    Test placement of blocks on servers
+    """
+
+    def setUp(self) -> None:
+        self.hashes = [os.urandom(32) for _ in range(10000)]
+
+    def test_owners(self):
+        ring = HashRing([f'localhost:{8080 + i}' for i in range(5)], 3)
+        for h in self.hashes[:100]:
+            owners = ring.owners(h)
+            self.assertEqual(len(set(owners)), 3)
+            self.assertEqual(owners[0], ring.owners(h)[0])
+        # more replicas than servers
+        self.assertEqual(sorted(HashRing(['a', 'b'], 3).owners(self.hashes[0])), [0, 1])
+
+    def test_balance(self):
+        ring = HashRing([f'localhost:{8080 + i}' for i in range(5)], 1)
+        counts = Counter(ring.owners(h)[0] for h in self.hashes)
+        for count in counts.values():
+            self.assertLess(abs(count - len(self.hashes) / 5), len(self.hashes) / 5 * 0.35)
+
+    def test_add_server(self):
+        """Only blocks of the new server move"""
+        nodes = [f'localhost:{8080 + i}' for i in range(5)]
+        ring, new_ring = HashRing(nodes, 2), HashRing(nodes + ['localhost:8085'], 2)
+        moved = 0
+        for h in self.hashes:
+            old, new = set(ring.owners(h)), set(new_ring.owners(h))
+            self.assertLessEqual(new - old, {5})
+            moved += bool(new - old)
+        # about replicas / servers of blocks
+        self.assertLess(moved, len(self.hashes) * 2 / 6 * 1.35)
+
+    def test_group(self):
+        ring = HashRing(['a', 'b', 'c'], 2)
+        groups = ring.group(self.hashes[:100])
+        self.assertEqual(sorted(i for indexes in groups.values() for i in indexes), list(range(100)))
+        for server_id, indexes in groups.items():
+            for i in indexes:
+                self.assertEqual(ring.owners(self.hashes[i])[0], server_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
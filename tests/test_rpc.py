@@ -0,0 +1,245 @@
+import os
+import threading
+import time
+import unittest
+from threading import Thread
+from xmlrpc.client import ServerProxy
+
+from src import codec
+from src.aioserver import AsyncRPCServer
+from src.client import ClusterProxy
+from src.rpc import BinaryRPCServer, BinaryServerProxy, RPCError
+from src.server import RequestHandler, SurfstoreServer, ThreadedXMLRPCServer, TimeoutTransport
+
+LEADER_ELECTION_TIMEOUT = 2
+
+
+class Echo:
+    def __init__(self):
+        self.released = threading.Event()
+
+    def _dispatch(self, method, params):
+        if method in ('echo', 'appendEntries'):
+            return params
+        if method == 'wait':
+            self.released.wait()
+            return params
+        raise Exception(f"unknown method {method}")
+
+
+def start_rpc_server(instance):
+    server = BinaryRPCServer(('127.0.0.1', 0))
+    server.register_instance(instance)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class TestCodec(unittest.TestCase):
+    def test_round_trip(self):
+        obj = {'lala.bin': [1, [os.urandom(32), os.urandom(32)]], 'empty': [2, []],
+               'misc': [None, True, False, -1, 1.5, 'ü', b'', (1 << 63) - 1]}
+        expected = dict(obj, misc=list(obj['misc']))
+        self.assertEqual(codec.loads(codec.dumps(obj)), expected)
+
+    def test_truncated(self):
+        data = codec.dumps([b'lala', 'lala'])
+        with self.assertRaises(Exception):
+            codec.loads(data[:-1])
+
+
+class TestBinaryRPC(unittest.TestCase):
+    """
+    Test binary RPC transport over local sockets
+    """
+
+    def setUp(self) -> None:
+        self.server = start_rpc_server(Echo())
+        self.proxy = BinaryServerProxy(*self.server.server_address)
+
+    def tearDown(self) -> None:
+        self.proxy._close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_call(self):
+        block = os.urandom(4096)
+        self.assertEqual(self.proxy.echo(block, 'lala', [1, 2]), [block, 'lala', [1, 2]])
+
+    def test_error(self):
+        with self.assertRaises(RPCError):
+            self.proxy.lala()
+        # connection is still usable after remote error
+        self.assertEqual(self.proxy.echo(1), [1])
+
+    def test_persistent_connection(self):
+        self.proxy.echo(1)
+        connection = self.proxy._local.connection
+        self.proxy.echo(2)
+        self.assertIs(self.proxy._local.connection, connection)
+
+    def test_concurrent_calls(self):
+        results = {}
+
+        def call(i):
+            results[i] = self.proxy.echo(i)
+
+        threads = [Thread(target=call, args=(i,)) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, {i: [i] for i in range(20)})
+
+    def test_server_down(self):
+        self.server.shutdown()
+        self.server.server_close()
+        proxy = BinaryServerProxy(*self.server.server_address)
+        with self.assertRaises(OSError):
+            proxy.echo(1)
+
+
+class TestAsyncRPC(unittest.TestCase):
+    """
+    Test asyncio RPC server with binary RPC clients
+    """
+
+    def setUp(self) -> None:
+        self.server = AsyncRPCServer(('127.0.0.1', 0), max_workers=4)
+        self.server.register_instance(Echo())
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.server.ready.wait()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.thread.join()
+
+    def test_call(self):
+        with BinaryServerProxy(*self.server.server_address) as proxy:
+            block = os.urandom(4096)
+            self.assertEqual(proxy.echo(block), [block])
+            with self.assertRaises(RPCError):
+                proxy.lala()
+
+    def test_many_connections(self):
+        """Open connections should not cost a thread each"""
+        threads_before = threading.active_count()
+        proxies = [BinaryServerProxy(*self.server.server_address) for _ in range(200)]
+        for i, proxy in enumerate(proxies):
+            self.assertEqual(proxy.echo(i), [i])
+        # only the bounded worker pool is added
+        self.assertLessEqual(threading.active_count(), threads_before + 4)
+        for proxy in proxies:
+            proxy._close()
+
+    def test_peer_calls_not_starved(self):
+        """RPCs between servers should be served while all workers wait in client calls"""
+        echo = self.server.instance
+        proxies = [BinaryServerProxy(*self.server.server_address) for _ in range(4)]
+        proxies.append(BinaryServerProxy(*self.server.server_address, timeout=1))
+        waiters = [Thread(target=proxy.wait, args=(i,)) for i, proxy in enumerate(proxies[:4])]
+        for t in waiters:
+            t.start()
+        try:
+            time.sleep(0.1)
+            self.assertEqual(proxies[4].appendEntries(1), [1])
+        finally:
+            echo.released.set()
+            for t in waiters:
+                t.join()
+            for proxy in proxies:
+                proxy._close()
+
+
+class TestXMLRPC(unittest.TestCase):
+    """
+    Test XML-RPC server with the transport used between servers
+    """
+
+    def setUp(self) -> None:
+        self.server = ThreadedXMLRPCServer(('127.0.0.1', 0), requestHandler=RequestHandler, use_builtin_types=True,
+                                           logRequests=False)
+        self.server.register_instance(Echo())
+        self.accepted = 0
+        get_request = self.server.get_request
+
+        def counting_get_request():
+            self.accepted += 1
+            return get_request()
+
+        self.server.get_request = counting_get_request
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        """Calls of a thread should reuse one connection"""
+        host, port = self.server.server_address
+        proxy = ServerProxy(f'http://{host}:{port}', transport=TimeoutTransport(1))
+        for i in range(20):
+            self.assertEqual(proxy.echo(i), [i])
+        self.assertEqual(self.accepted, 1)
+        proxy('close')()
+
+
+class TestBinaryCluster(unittest.TestCase):
+    """
+    Test Raft between servers over binary RPC transport
+    """
+
+    def setUp(self) -> None:
+        self.N = 3
+        self.rpc_servers = [BinaryRPCServer(('127.0.0.1', 0)) for _ in range(self.N)]
+        server_list = [rpc_server.server_address for rpc_server in self.rpc_servers]
+        self.surfstores = {}
+        for i, rpc_server in enumerate(self.rpc_servers):
+            self.surfstores[i] = SurfstoreServer(SurfstoreServer.set_up_connections(server_list, i, 'binary'), i,
+                                                 self.N)
+            rpc_server.register_instance(self.surfstores[i])
+            Thread(target=rpc_server.serve_forever, daemon=True).start()
+
+    def tearDown(self) -> None:
+        for surfstore in self.surfstores.values():
+            surfstore.crash()
+        for rpc_server in self.rpc_servers:
+            rpc_server.shutdown()
+            rpc_server.server_close()
+
+    def test_updatefile(self):
+        for surfstore in self.surfstores.values():
+            surfstore.restore()
+        time.sleep(LEADER_ELECTION_TIMEOUT)
+        leaders = [i for i, surfstore in self.surfstores.items() if surfstore.isLeader()]
+        self.assertEqual(len(leaders), 1)
+
+        host, port = self.rpc_servers[leaders[0]].server_address
+        with BinaryServerProxy(host, port) as proxy:
+            self.assertTrue(proxy.updatefile('lala.bin', 1, [os.urandom(32)]))
+            self.assertEqual(proxy.getfileinfomap()['lala.bin'][0], 1)
+
+    def test_cluster_proxy(self):
+        """Calls should follow the leader, also after it crashes"""
+        for surfstore in self.surfstores.values():
+            surfstore.restore()
+        time.sleep(LEADER_ELECTION_TIMEOUT)
+        leaders = [i for i, surfstore in self.surfstores.items() if surfstore.isLeader()]
+        self.assertEqual(len(leaders), 1)
+
+        proxies = [BinaryServerProxy(*rpc_server.server_address) for rpc_server in self.rpc_servers]
+        with ClusterProxy(proxies, (leaders[0] + 1) % self.N) as proxy:
+            self.assertTrue(proxy.updatefile('lala.bin', 1, [os.urandom(32)]))
+            self.assertEqual(proxy.leader, leaders[0])
+
+            self.surfstores[leaders[0]].crash()
+            self.assertTrue(proxy.updatefile('lala.bin', 2, [os.urandom(32)]))
+            self.assertNotEqual(proxy.leader, leaders[0])
+            self.assertTrue(self.surfstores[proxy.leader].isLeader())
+            self.assertEqual(proxy.getfileinfomap()['lala.bin'][0], 2)
+            with self.assertRaises(RPCError):
+                proxy.getblock(os.urandom(32))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,7 @@
 import os
 import unittest
 from hashlib import sha256
-from src.surfstore import SurfStore
+from src.surfstore import SurfStore, MAX_BATCH_BYTES
 
 
 class TestServerAlone(unittest.TestCase):
@@ -18,6 +18,16 @@ class TestServerAlone(unittest.TestCase):
         self.server.putblock(b)
         self.assertEqual(b, self.server.getblock(sha256(b).digest()))
 
+    def test_get_put_blocks(self):
+        bs = [os.urandom(1 << 20) for _ in range(MAX_BATCH_BYTES // (1 << 20) + 2)]
+        self.assertTrue(self.server.putblocks(bs))
+        hs = [sha256(b).digest() for b in bs]
+        # blocks beyond MAX_BATCH_BYTES are left for the next call
+        got = self.server.getblocks(hs)
+        self.assertEqual(got, bs[:len(got)])
+        self.assertLess(len(got), len(bs))
+        self.assertEqual(self.server.getblocks(hs[len(got):]), bs[len(got):])
+
     def test_info(self):
         infos = self.server.getfileinfomap()
         self.assertEqual(infos, {})
@@ -30,6 +40,25 @@ class TestServerAlone(unittest.TestCase):
         self.server.updatefile(file_name, infos[file_name][0], infos[file_name][1])
         self.assertEqual(infos, self.server.getfileinfomap())
 
+    def test_info_since(self):
+        h = sha256(os.urandom(4096)).digest()
+        self.server.updatefile('lala.bin', 1, [h])
+        self.server.updatefile('lala2.bin', 1, [h])
+        cursor, whole, infos = self.server.getfileinfomap_since(0)
+        self.assertTrue(whole)
+        self.assertEqual(infos, self.server.getfileinfomap())
+
+        self.assertEqual(self.server.getfileinfomap_since(cursor), [cursor, False, {}])
+        self.server.updatefile('lala.bin', 2, [])
+        self.assertFalse(self.server.updatefile('lala2.bin', 3, []))
+        self.assertEqual(self.server.getfileinfomap_since(cursor), [cursor + 1, False, {'lala.bin': [2, []]}])
+
+        # changes before a restored snapshot are unknown
+        server = SurfStore()
+        server.restore(self.server.snapshot())
+        self.assertEqual(server.getfileinfomap_since(cursor), [cursor + 1, True, self.server.getfileinfomap()])
+        self.assertEqual(server.getfileinfomap_since(cursor + 1), [cursor + 1, False, {}])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,184 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from hashlib import sha256
+from threading import Event
+
+from src import codec
+from src.server import SurfstoreServer
+from src.surfstore import SurfStore
+from src.wal import WriteAheadLog
+
+LEADER_ELECTION_TIMEOUT = 2
+
+
+class TestWriteAheadLog(unittest.TestCase):
+    """
+    Test write-ahead log recovery without RPC
+    """
+
+    def setUp(self) -> None:
+        self.wal_dir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.wal_dir)
+
+    def test_recover(self):
+        wal = WriteAheadLog(self.wal_dir)
+        self.assertEqual(wal.recover(), (0, None, None, [], 0))
+        h = sha256(os.urandom(4096)).digest()
+        wal.set_hard_state(1, 2)
+        wal.append_entries(1, [(1, ('lala.bin', 1, [h])), (1, ('lala2.bin', 1, [h]))])
+        # conflicting entry replaces the second one
+        wal.append_entries(2, [(2, ('lala.bin', 2, []))])
+        wal.set_commit_index(2)
+        wal.sync()
+        wal.close()
+
+        wal = WriteAheadLog(self.wal_dir)
+        self.assertEqual(wal.recover(), (1, 2, None, [(1, ('lala.bin', 1, [h])), (2, ('lala.bin', 2, []))], 2))
+
+    def test_segments(self):
+        wal = WriteAheadLog(self.wal_dir, segment_size=100)
+        wal.recover()
+        for i in range(1, 11):
+            wal.append_entries(i, [(1, (f'lala{i}.bin', 1, []))])
+        wal.close()
+        self.assertGreater(len(wal.segments()), 1)
+
+        wal = WriteAheadLog(self.wal_dir, segment_size=100)
+        _, _, _, logs, _ = wal.recover()
+        self.assertEqual(logs, [(1, (f'lala{i}.bin', 1, [])) for i in range(1, 11)])
+
+    def test_torn_tail(self):
+        wal = WriteAheadLog(self.wal_dir)
+        wal.recover()
+        wal.append_entries(1, [(1, ('lala.bin', 1, []))])
+        wal.append_entries(2, [(1, ('lala2.bin', 1, []))])
+        wal.close()
+        path = os.path.join(self.wal_dir, wal.segments()[-1])
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 1)
+
+        wal = WriteAheadLog(self.wal_dir)
+        _, _, _, logs, _ = wal.recover()
+        self.assertEqual(logs, [(1, ('lala.bin', 1, []))])
+        # log is still appendable after truncating the torn record
+        wal.append_entries(2, [(2, ('lala3.bin', 1, []))])
+        wal.close()
+        _, _, _, logs, _ = WriteAheadLog(self.wal_dir).recover()
+        self.assertEqual(logs, [(1, ('lala.bin', 1, [])), (2, ('lala3.bin', 1, []))])
+
+    def test_server_recover(self):
+        h = sha256(os.urandom(4096)).digest()
+        wal = WriteAheadLog(self.wal_dir)
+        wal.recover()
+        wal.set_hard_state(3, None)
+        wal.append_entries(1, [(1, ('lala.bin', 1, [h])), (2, ('lala.bin', 2, [h, h])), (3, ('lala2.bin', 1, []))])
+        wal.set_commit_index(2)
+        wal.close()
+
+        server = SurfstoreServer({}, 0, 1, wal_dir=self.wal_dir)
+        self.assertEqual(server.current_term, 3)
+        self.assertEqual(len(server.logs), 3)
+        self.assertEqual(server.commit_index, 2)
+        self.assertEqual(server.last_applied, 2)
+        self.assertEqual(server.surfstore.file_infos, {'lala.bin': [2, [h, h]]})
+        server.wal.close()
+
+    def test_snapshot(self):
+        wal = WriteAheadLog(self.wal_dir, segment_size=100)
+        wal.recover()
+        wal.set_hard_state(2, 1)
+        logs = [(1, (f'lala{i}.bin', 1, [])) for i in range(1, 11)]
+        wal.append_entries(1, logs)
+        segments = wal.segments()
+        wal.save_snapshot(8, 1, b'snapshot', 2, 1, logs[8:], 9)
+        # compacted segments are deleted
+        self.assertFalse(set(segments) & set(wal.segments()))
+        wal.append_entries(11, [(2, ('lala11.bin', 1, []))])
+        wal.close()
+
+        wal = WriteAheadLog(self.wal_dir)
+        self.assertEqual(wal.recover(), (2, 1, (8, 1, b'snapshot'), logs[8:] + [(2, ('lala11.bin', 1, []))], 9))
+
+    def test_crash_before_compact(self):
+        """Logs in a snapshot are committed even if the commit record is lost"""
+        wal = WriteAheadLog(self.wal_dir)
+        wal.recover()
+        wal.set_hard_state(1, 0)
+        logs = [(1, (f'lala{i}.bin', 1, [])) for i in range(1, 6)]
+        wal.append_entries(1, logs)
+        wal.set_commit_index(1)
+        surfstore = SurfStore()
+        for _, cmd in logs:
+            surfstore.updatefile(*cmd)
+        wal.write_snapshot(5, 1, codec.dumps(surfstore.snapshot()))
+        wal.close()
+
+        wal = WriteAheadLog(self.wal_dir)
+        _, _, snapshot, logs, commit_index = wal.recover()
+        self.assertEqual((snapshot[0], logs, commit_index), (5, [], 5))
+        wal.close()
+
+        server = SurfstoreServer({}, 0, 1, wal_dir=self.wal_dir)
+        self.assertEqual((server.commit_index, server.last_applied), (5, 5))
+        server.restore()
+        time.sleep(LEADER_ELECTION_TIMEOUT)
+        self.assertEqual(len(server.getfileinfomap()), 5)
+        server.crash()
+        server.wal.close()
+
+    def test_server_recover_snapshot(self):
+        server = SurfstoreServer({}, 0, 1, wal_dir=self.wal_dir)
+        server.snapshot_threshold = 3
+        server.restore()
+        time.sleep(LEADER_ELECTION_TIMEOUT)
+        for i in range(10):
+            self.assertTrue(server.updatefile(f'lala{i}.bin', 1, []))
+        file_infos = server.getfileinfomap()
+        server.snapshot_thread.join()
+        snapshot_index, last_log_index = server.snapshot_index, server.last_log_index()
+        self.assertGreater(snapshot_index, 0)
+        server.crash()
+        server.wal.close()
+
+        server = SurfstoreServer({}, 0, 1, wal_dir=self.wal_dir)
+        self.assertEqual(server.snapshot_index, snapshot_index)
+        self.assertEqual(server.last_log_index(), last_log_index)
+        self.assertEqual(server.surfstore.file_infos, file_infos)
+        server.wal.close()
+
+    def test_snapshot_in_background(self):
+        """Updates should commit while a snapshot is being written"""
+        server = SurfstoreServer({}, 0, 1, wal_dir=self.wal_dir)
+        server.snapshot_threshold = 3
+        write_snapshot, released = server.wal.write_snapshot, Event()
+
+        def slow_write_snapshot(*args):
+            released.wait()
+            return write_snapshot(*args)
+
+        server.wal.write_snapshot = slow_write_snapshot
+        server.restore()
+        time.sleep(LEADER_ELECTION_TIMEOUT)
+        for i in range(10):
+            self.assertTrue(server.updatefile(f'lala{i}.bin', 1, []))
+        self.assertEqual(server.snapshot_index, 0)
+        released.set()
+        server.snapshot_thread.join()
+        self.assertEqual(server.snapshot_index, 3)
+        self.assertEqual(server.last_log_index(), 10)
+        server.crash()
+        server.wal.close()
+
+        server = SurfstoreServer({}, 0, 1, wal_dir=self.wal_dir)
+        self.assertEqual(server.snapshot_index, 3)
+        self.assertEqual(len(server.surfstore.file_infos), 10)
+        server.wal.close()
+
+
+if __name__ == '__main__':
+    unittest.main()